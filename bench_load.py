@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+Load benchmark for server.py.
+Starts a server in its own process on a loopback port, connects simulated clients that register, join channels of
+--channel-size members and then send PRIVMSGs at --rate per second, parting and rejoining now and then if --churn
+is given. Reports message throughput, p50/p99 delivery latency, and the server's CPU use and memory. Everything random
+is seeded, so runs with the same options are comparable. Pass --server with the path to another copy of server.py
+(for example one extracted with `git show <rev>:server.py`) to measure that one instead
+"""
+
+import argparse
+import heapq
+import importlib.util
+import json
+import multiprocessing
+import os
+import random
+import resource
+import selectors
+import socket
+import time
+from array import array
+from types import ModuleType
+from typing import Dict, List, Optional
+
+READ_SIZE = 2 ** 16
+
+
+def load(path: Optional[str]) -> ModuleType:
+    if path is None:
+        import server
+        return server
+    spec = importlib.util.spec_from_file_location("benchmarked_server", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def raise_file_limit() -> None:
+    "Every client takes a file descriptor on both sides"
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def serve(path: Optional[str], ports: "multiprocessing.connection.Connection") -> None:
+    "Runs in the server process"
+    raise_file_limit()
+    module = load(path)
+    srv = module.Server()
+    srv.flood_rate = 0  # senders go over any sensible flood rate with --rate above a couple a second
+    listener = socket.socket(socket.AF_INET6)
+    listener.bind(("::1", 0))
+    listener.listen(socket.SOMAXCONN)
+    listener.setblocking(False)
+    ports.send(listener.getsockname()[1])
+    srv.run(listener)
+
+
+def process_usage(pid: int) -> Dict[str, float]:
+    "CPU seconds used so far and memory in bytes, read from /proc. Empty where there is no /proc"
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status") as status:
+            memory = dict(line.split(":", 1) for line in status if line.startswith(("VmRSS", "VmHWM")))
+    except OSError:
+        return {}
+    ticks = os.sysconf("SC_CLK_TCK")
+    return {
+        "cpu": (int(fields[11]) + int(fields[12])) / ticks,  # utime and stime
+        "rss": int(memory["VmRSS"].split()[0]) * 1024,
+        "peak_rss": int(memory["VmHWM"].split()[0]) * 1024,
+    }
+
+
+class LoadClient:
+    "One simulated IRC client"
+    __slots__ = ("index", "nick", "channel", "socket", "incoming", "outgoing", "joined")
+
+    def __init__(self, index: int, channel_size: int) -> None:
+        self.index = index
+        self.nick = b"load%d" % index
+        self.channel = b"#load%d" % (index // channel_size)
+        self.socket = None
+        self.incoming = b""
+        self.outgoing = bytearray()
+        self.joined = False
+
+
+class Generator:
+    "Runs a share of the clients in one process, all on one selector"
+
+    def __init__(self, port: int, first: int, count: int, args: argparse.Namespace) -> None:
+        self.port = port
+        self.args = args
+        self.selector = selectors.DefaultSelector()
+        self.clients = [LoadClient(index, args.channel_size) for index in range(first, first + count)]
+        self.random = random.Random(args.seed * 1000003 + first)
+        self.measuring = False
+        self.sent = 0
+        self.received = 0
+        self.latencies = array("q")
+
+    def connect(self) -> None:
+        "Connects, registers and joins every client, a batch at a time, and waits until they're all on their channel"
+        for start in range(0, len(self.clients), self.args.connect_batch):
+            for client in self.clients[start:start + self.args.connect_batch]:
+                client.socket = socket.create_connection(("::1", self.port))
+                client.socket.setblocking(False)
+                self.selector.register(client.socket, selectors.EVENT_READ, client)
+                self.send(client, b"NICK %s\r\nUSER %s 0 * :load client\r\nJOIN %s\r\n"
+                          % (client.nick, client.nick, client.channel))
+            self.poll(0)
+        deadline = time.monotonic() + 60
+        while not all(client.joined for client in self.clients):
+            if time.monotonic() > deadline:
+                raise TimeoutError("clients didn't all get on their channels within a minute")
+            self.poll(0.1)
+
+    def run(self, start: float, warmup: float, duration: float) -> None:
+        """
+        Sends from every sender at its rate until `start + warmup + duration`, only counting what happens after
+        the warmup. Times are time.monotonic(), which all processes on the machine share
+        """
+        senders = self.clients[:max(1, round(len(self.clients) * self.args.senders))]
+        interval = 1 / self.args.rate
+        due = [(start + self.random.random() * interval, client.index, client) for client in senders]
+        heapq.heapify(due)
+        churn = self.args.churn / self.args.rate  # chance of a part and rejoin per message sent
+        measured_from = start + warmup
+        end = measured_from + duration
+        while True:
+            now = time.monotonic()
+            if now >= end:
+                break
+            self.measuring = now >= measured_from
+            while due and due[0][0] <= now:
+                when, index, client = heapq.heappop(due)
+                if churn and self.random.random() < churn:
+                    self.send(client, b"PART %s :brb\r\nJOIN %s\r\n" % (client.channel, client.channel))
+                self.send(client, b"PRIVMSG %s :%d\r\n" % (client.channel, time.monotonic_ns()))
+                if self.measuring:
+                    self.sent += 1
+                heapq.heappush(due, (when + interval, index, client))
+            self.poll(max(0, min(due[0][0] if due else end, end) - time.monotonic()))
+        self.measuring = False
+
+    def send(self, client: LoadClient, data: bytes) -> None:
+        if not client.outgoing:
+            try:
+                sent = client.socket.send(data)
+            except BlockingIOError:
+                sent = 0
+            if sent == len(data):
+                return
+            data = data[sent:]
+            self.selector.modify(client.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, client)
+        client.outgoing += data
+
+    def poll(self, timeout: float) -> None:
+        for key, mask in self.selector.select(timeout):
+            client = key.data
+            if mask & selectors.EVENT_READ:
+                self.read(client)
+            if mask & selectors.EVENT_WRITE:
+                try:
+                    sent = client.socket.send(client.outgoing)
+                except BlockingIOError:
+                    continue
+                del client.outgoing[:sent]
+                if not client.outgoing:
+                    self.selector.modify(client.socket, selectors.EVENT_READ, client)
+
+    def read(self, client: LoadClient) -> None:
+        try:
+            data = client.socket.recv(READ_SIZE)
+        except BlockingIOError:
+            return
+        if not data:
+            raise ConnectionError(f"the server closed {client.nick.decode()}'s connection")
+        now = time.monotonic_ns()
+        lines = (client.incoming + data).split(b"\r\n")
+        client.incoming = lines.pop()
+        for line in lines:
+            if b" PRIVMSG " in line:
+                if self.measuring:
+                    self.received += 1
+                    self.latencies.append(now - int(line.rsplit(b":", 1)[1]))
+            elif line.startswith(b"PING"):
+                self.send(client, b"PONG%s\r\n" % line[4:])
+            elif b" JOIN " in line and line[1:].startswith(client.nick + b"!"):
+                client.joined = True
+
+    def close(self) -> None:
+        for client in self.clients:
+            try:
+                client.socket.sendall(b"QUIT :done\r\n")
+            except OSError:
+                pass
+            client.socket.close()
+
+
+def generate(port: int, first: int, count: int, args: argparse.Namespace,
+             ready: "multiprocessing.synchronize.Barrier", starts: "multiprocessing.Queue",
+             results: "multiprocessing.Queue") -> None:
+    "Runs in each load generating process"
+    raise_file_limit()
+    generator = Generator(port, first, count, args)
+    generator.connect()
+    ready.wait()
+    start = starts.get()
+    cpu = time.process_time()
+    generator.run(start, args.warmup, args.duration)
+    results.put({"sent": generator.sent, "received": generator.received,
+                 "latencies": generator.latencies.tobytes(), "cpu": time.process_time() - cpu})
+    generator.close()
+
+
+def percentile(ordered: List[int], q: float) -> float:
+    if not ordered:
+        return float("nan")
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", help="simulated clients. Defaults to 1000", type=int, default=1000)
+    parser.add_argument("--channel-size", help="clients per channel. Defaults to 10", type=int, default=10)
+    parser.add_argument("--senders", help="fraction of the clients that send messages. Defaults to 1",
+                        type=float, default=1.0)
+    parser.add_argument("--rate", help="messages per second from each sender. Defaults to 1", type=float, default=1.0)
+    parser.add_argument("--churn", help="times per second each sender parts and rejoins its channel. Defaults to 0",
+                        type=float, default=0.0)
+    parser.add_argument("--duration", help="seconds measured. Defaults to 10", type=float, default=10.0)
+    parser.add_argument("--warmup", help="seconds of load before measuring starts. Defaults to 2",
+                        type=float, default=2.0)
+    parser.add_argument("--processes", help="load generating processes. Use more if they, rather than the server, "
+                        "end up using a whole core. Defaults to 1", type=int, default=1)
+    parser.add_argument("--connect-batch", help="connections opened before waiting for the server to catch up. "
+                        "Defaults to 100", type=int, default=100)
+    parser.add_argument("--seed", help="seed for everything random. Defaults to 1", type=int, default=1)
+    parser.add_argument("--server", help="path to another server.py to benchmark")
+    parser.add_argument("--json", help="print the results as json", action="store_true")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("fork")
+    ports, server_end = context.Pipe()
+    server = context.Process(target=serve, args=(args.server, server_end), daemon=True)
+    server.start()
+    port = ports.recv()
+
+    ready = context.Barrier(args.processes + 1)
+    starts = context.Queue()
+    results = context.Queue()
+    share, extra = divmod(args.clients, args.processes)
+    generators = []
+    first = 0
+    for number in range(args.processes):
+        count = share + (number < extra)
+        generators.append(context.Process(target=generate, args=(port, first, count, args, ready, starts, results),
+                                          daemon=True))
+        first += count
+    connect_start = time.monotonic()
+    for generator in generators:
+        generator.start()
+    try:
+        ready.wait(timeout=120)
+        connect_time = time.monotonic() - connect_start
+        start = time.monotonic() + 0.1
+        for _ in generators:
+            starts.put(start)
+        time.sleep(max(0, start + args.warmup - time.monotonic()))
+        before = process_usage(server.pid)
+        time.sleep(args.duration)
+        after = process_usage(server.pid)
+        reports = [results.get(timeout=60 + args.duration) for _ in generators]
+    finally:
+        for generator in generators:
+            generator.join(timeout=5)
+            if generator.is_alive():
+                generator.terminate()
+        server.terminate()
+
+    latencies = array("q")
+    for report in reports:
+        latencies.frombytes(report["latencies"])
+    ordered = sorted(latencies)
+    sent = sum(report["sent"] for report in reports)
+    received = sum(report["received"] for report in reports)
+    expected = sent * (args.channel_size - 1)
+    summary = {
+        "clients": args.clients,
+        "connect_seconds": connect_time,
+        "messages_per_second": sent / args.duration,
+        "deliveries_per_second": received / args.duration,
+        "delivered_fraction": received / expected if expected else float("nan"),
+        "latency_p50_ms": percentile(ordered, 0.5) / 1e6,
+        "latency_p99_ms": percentile(ordered, 0.99) / 1e6,
+        "latency_max_ms": (ordered[-1] / 1e6) if ordered else float("nan"),
+        "generator_cpu_percent": 100 * sum(report["cpu"] for report in reports) / (args.warmup + args.duration),
+    }
+    if before and after:
+        summary["server_cpu_percent"] = 100 * (after["cpu"] - before["cpu"]) / args.duration
+        summary["server_rss_mib"] = after["rss"] / 2 ** 20
+        summary["server_peak_rss_mib"] = after["peak_rss"] / 2 ** 20
+
+    if args.json:
+        print(json.dumps(summary))
+    else:
+        for name, value in summary.items():
+            print(f"{name:24} {value:12,.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark for the objects there is one of per connection and per line.
+Reports the bytes each connected, named client on a channel costs the server, and the bytes each parsed command
+keeps alive. Pass --compare-server and --compare-command with the paths to other copies of server.py and
+bot/command.py (for example ones extracted with `git show <rev>:server.py`) to measure those as well
+"""
+
+import argparse
+import importlib.util
+import socket
+import tracemalloc
+from types import ModuleType
+from typing import List, Tuple
+
+import server
+from bot import command
+
+LINES = [
+    b":alice!alice@2001:db8::1 PRIVMSG #test :has anyone tried the new build yet?",
+    b":dave!dave@10.0.0.7 JOIN #test",
+    b":erin!erin@10.0.0.8 PART #test :see you tomorrow",
+    b"PING :fc00:1337::17",
+    b":irc.example.org 353 microbot = #test :@alice bob +carol dave erin frank",
+]
+
+
+def load(name: str, path: str) -> ModuleType:
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def connect(count: int) -> Tuple[List[socket.socket], List[socket.socket]]:
+    "Open `count` loopback connections, returning the accepted ends and the connecting ends"
+    listener = socket.socket(socket.AF_INET6)
+    listener.bind(("::1", 0))
+    listener.listen(count)
+    accepted, connecting = [], []
+    for _ in range(count):
+        connecting.append(socket.create_connection(listener.getsockname()[:2]))
+        accepted.append(listener.accept()[0])
+    listener.close()
+    return accepted, connecting
+
+
+def bytes_per_connection(module: ModuleType, sockets: List[socket.socket], channels: int) -> float:
+    "Memory allocated by the server for each client, including its nickname and its place on a channel"
+    srv = module.Server()
+    names = [b"#channel%d" % i for i in range(channels)]
+    tracemalloc.start()
+    clients = []
+    for i, conn in enumerate(sockets):
+        client = module.Client(srv, conn)
+        srv.clients.add(client)
+        srv.rename_client(client, b"user%d" % i)
+        channel = srv.get_channel(names[i % channels])
+        if channel is None:
+            channel = module.Channel(srv, names[i % channels])
+            srv.add_channel(channel)
+        channel.add_member(client)
+        client.channels.add(channel)
+        clients.append(client)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / len(sockets)
+
+
+def bytes_per_message(module: ModuleType, count: int) -> float:
+    "Memory kept alive by each parsed command, with its prefix parsed"
+    lines = [LINES[i % len(LINES)] for i in range(count)]
+    tracemalloc.start()
+    parsed = [module.Command(line) for line in lines]
+    for line in parsed:
+        line.prefix
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", help="connections to open. Each one takes two file descriptors",
+                        type=int, default=400)
+    parser.add_argument("--channels", help="channels to spread the connections over", type=int, default=10)
+    parser.add_argument("--messages", help="lines to parse", type=int, default=100000)
+    parser.add_argument("--compare-server", help="path to another server.py to measure")
+    parser.add_argument("--compare-command", help="path to another bot/command.py to measure")
+    args = parser.parse_args()
+
+    servers = {"current": server}
+    if args.compare_server:
+        servers["compared"] = load("compared_server", args.compare_server)
+    commands = {"current": command}
+    if args.compare_command:
+        commands["compared"] = load("compared_command", args.compare_command)
+
+    accepted, connecting = connect(args.connections)
+    try:
+        for name, module in servers.items():
+            print(f"{name:9} {bytes_per_connection(module, accepted, args.channels):8.0f} bytes/connection")
+    finally:
+        for conn in accepted + connecting:
+            conn.close()
+    for name, module in commands.items():
+        print(f"{name:9} {bytes_per_message(module, args.messages):8.0f} bytes/message")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+This module contains an asyncio version of the bot, which keeps answering the server while slow command handlers run
+"""
+
+import asyncio
+import concurrent.futures
+import socket
+import time
+from types import TracebackType
+from typing import Any, Callable, Coroutine, Optional, Set, Type, TypeVar
+
+import bot
+import command
+import plugins
+
+T = TypeVar("T")
+
+
+class AsyncBot(bot.Bot):
+    """
+    A bot driven by an asyncio event loop. It shares `bot.Bot`'s handler table: plain handlers run inline, like
+    they do there, while handlers that are coroutine functions run as tasks, at most `max_concurrency` at once.
+    Blocking work can be moved off the event loop with `offload`
+    """
+    _family: socket.AddressFamily
+    _reader: Optional[asyncio.StreamReader]
+    _writer: Optional[asyncio.StreamWriter]
+    _tasks: Set["asyncio.Task[None]"]
+    _limit: asyncio.Semaphore
+    _max_pending: int  # handler tasks allowed to wait for the semaphore before new ones are dropped
+    _executor: Optional[concurrent.futures.Executor]
+    _flush_timer: Optional[asyncio.TimerHandle]
+
+    def __init__(self, name: bytes, port: int, ipv6: bool = True, debug: bool = False,
+                 send_rate: float = 0.5, send_burst: int = 5, triggers: Optional[plugins.Registry] = None,
+                 cache_size: int = 256, max_concurrency: int = 8,
+                 executor: Optional[concurrent.futures.Executor] = None) -> None:
+        """
+        `executor` is where `offload` runs blocking functions. By default that's the event loop's thread pool,
+        but a `concurrent.futures.ProcessPoolExecutor` can be passed for CPU bound work
+        """
+        super().__init__(name, port, ipv6, debug, send_rate, send_burst, triggers, cache_size)
+        self._flush_timer = None
+        self._reader = None
+        self._writer = None
+        self._tasks = set()
+        self._limit = asyncio.Semaphore(max_concurrency)
+        self._max_pending = max_concurrency * 4
+        self._executor = executor
+
+    def _open_socket(self, addr_family: socket.AddressFamily) -> None:
+        # The streams are only opened once we know where to connect to
+        self._family = addr_family
+
+    async def __aenter__(self) -> "AsyncBot":
+        return self
+
+    async def __aexit__(self, exc_type: Optional[Type[BaseException]], exc_value: Optional[BaseException], exc_traceback: Optional[TracebackType]) -> Optional[bool]:
+        # Same as `bot.Bot.__exit__`: there's no point retrying a failed quit, so it's only logged
+        is_os_error = isinstance(exc_value, OSError)
+        if self._debug:
+            print(f"reply cache: {self.response_cache}")
+        if is_os_error and self._debug:
+            print(f"An OS Error has occurred. This bot will now shut down.\n"
+                  f"\tError: {exc_value}")
+        try:
+            if is_os_error:
+                await self.quit(f"An error has occurred. {self._name.decode()} will now disconnect")
+            else:
+                await self.quit("Leaving")
+        except OSError as e:
+            if self._debug:
+                print("An OS error has occurred while trying to quit. The IRC connection may not have been "
+                      "terminated, and the socket may not have been closed\n"
+                      f"\tError: {e}")
+        return is_os_error
+
+    async def connect_to_server(self, server: bytes) -> None:
+        """
+        Establish a connection to the specified IRC server, sending the NICK and USER messages
+        """
+        self._reader, self._writer = await asyncio.open_connection(server.decode(), self._port, family=self._family)
+        self._register()
+
+    async def receive_forever(self) -> None:
+        """
+        Receive commands and handle them until the server closes the connection.
+        Handlers that are coroutine functions don't hold this up, so PINGs are answered even while they run
+        """
+        assert self._reader is not None and self._writer is not None
+        while True:
+            data = await self._reader.read(bot.RECV_SIZE)
+            if not data:
+                if self._debug:
+                    print("the server closed the connection")
+                return
+            for command in self._parse_commands(data):
+                self._command_handler(command)
+            await self._writer.drain()
+
+    async def offload(self, function: Callable[..., T], *args: Any) -> T:
+        """
+        Run a blocking function in the executor and wait for its result without blocking the event loop.
+        Meant to be awaited from a handler, which already counts towards the concurrency limit
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    async def quit(self, message: str) -> None:
+        """
+        Cancel any running handlers, quit the server and close the connection
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._roster.clear()
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+        if self._writer is None:
+            return
+        # Anything still held back by the rate limiter is dropped, the QUIT itself goes out right away
+        self._write(b"QUIT :%s\r\n" % message.encode())
+        self._writer.close()
+        await self._writer.wait_closed()
+
+    def _command_handler(self, received: command.Command) -> None:
+        # The prefix is only parsed when a handler first looks at it, so a malformed one surfaces here.
+        # Coroutine handlers report their errors from _run_limited
+        try:
+            if self._debug:
+                print(f"in: {received}")
+
+            handler = self._handlers.get(received.command)
+            if handler is None:  # Ignore unknown commands and replies
+                return
+            if asyncio.iscoroutinefunction(handler):
+                self._start(handler(self, received))
+            else:
+                handler(self, received)
+        except command.Error:
+            if self._debug:
+                print(f"ignoring malformed line: {received.command!r} {received.args!r}")
+
+    def _run_trigger(self, trigger: plugins.Trigger, message: plugins.Message) -> None:
+        if not asyncio.iscoroutinefunction(trigger.handler):
+            super()._run_trigger(trigger, message)
+            return
+        reply = self._cached_reply(trigger, message)
+        if reply is None:
+            self._start(self._reply_when_done(trigger, message))
+        elif reply:
+            self._send_privmsg(message.reply_to, reply)
+
+    async def _reply_when_done(self, trigger: plugins.Trigger, message: plugins.Message) -> None:
+        reply = self._store_reply(trigger, message, await trigger.handler(self, message))
+        if reply:
+            self._send_privmsg(message.reply_to, reply)
+
+    def _start(self, handler: Coroutine[Any, Any, None]) -> None:
+        if len(self._tasks) >= self._max_pending:
+            handler.close()
+            if self._debug:
+                print("too many command handlers are running, dropping a command")
+            return
+        task = asyncio.create_task(self._run_limited(handler))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_limited(self, handler: Coroutine[Any, Any, None]) -> None:
+        async with self._limit:
+            try:
+                await handler
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self._debug:
+                    print(f"A command handler has failed.\n"
+                          f"\tError: {e}")
+
+    def _flush(self) -> None:
+        super()._flush()
+        # Nothing wakes the event loop up just because the rate limiter allows another line, so set a timer
+        delay = self._outbound.delay(time.monotonic())
+        if delay is not None and self._flush_timer is None:
+            self._flush_timer = asyncio.get_running_loop().call_later(delay, self._flush_later)
+
+    def _flush_later(self) -> None:
+        self._flush_timer = None
+        self._flush()
+
+    def _write(self, data: bytes) -> None:
+        assert self._writer is not None
+        self._writer.write(data)
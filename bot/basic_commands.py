@@ -0,0 +1,23 @@
+"""
+The commands every bot has. Importing this module registers them
+"""
+
+import plugins
+
+
+@plugins.command("!hello")
+def hello(bot, message: plugins.Message) -> str:
+    return f"Hello, {message.nick.decode()}!"
+
+
+@plugins.command("!slap", cooldown=10)
+def slap(bot, message: plugins.Message) -> str:
+    target = message.args.split(" ", 1)[0] if message.args else message.nick.decode()
+    if not message.is_private and bot.get_user(target.encode()) is None:
+        return f"I don't see {target} here"
+    return f"\x01ACTION slaps {target} around a bit with a large trout\x01"
+
+
+@plugins.command("!help", cache_ttl=300)
+def help(bot, message: plugins.Message) -> str:
+    return "Commands: " + ", ".join(sorted(bot.triggers.words()))
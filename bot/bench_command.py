@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the IRC message parser in command.py.
+Reports parsed lines per second and the allocations left behind by each parsed line, over a few mixes of
+realistic traffic. Pass --compare with the path to another copy of command.py (for example one extracted with
+`git show <rev>:bot/command.py`) to run the same mixes against it and print the speedup. Older versions import
+parsers.py, extract that into the same directory with `git show <rev>:bot/parsers.py`
+"""
+
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import time
+import tracemalloc
+from types import ModuleType
+from typing import Dict, List
+
+import command
+
+CHANNEL_TRAFFIC = [
+    b":alice!alice@2001:db8::1 PRIVMSG #test :has anyone tried the new build yet?",
+    b":bob!~bob@host-12.example.net PRIVMSG #test :yes, works fine here : no complaints",
+    b":carol!carol@irc.example.org PRIVMSG #test :!slap bob",
+    b":dave!dave@10.0.0.7 JOIN #test",
+    b":erin!erin@10.0.0.8 PART #test :see you tomorrow",
+    b":frank!frank@10.0.0.9 QUIT :Ping timeout: 120 seconds",
+    b":alice!alice@2001:db8::1 NICK alice_",
+    b"PING :fc00:1337::17",
+    b":irc.example.org NOTICE microbot :*** Looking up your hostname",
+]
+
+SERVER_REPLIES = [
+    b":irc.example.org 001 microbot :Welcome to the Internet Relay Network microbot",
+    b":irc.example.org 004 microbot irc.example.org 1.0 iow ntkl",
+    b":irc.example.org 353 microbot = #test :@alice bob +carol dave erin frank",
+    b":irc.example.org 366 microbot #test :End of /NAMES list.",
+    b":irc.example.org 332 microbot #test :Channel topic goes here",
+]
+
+WHO_REPLIES = [
+    b":irc.example.org 352 microbot #test alice 2001:db8::1 irc.example.org alice H@ :0 Alice",
+    b":irc.example.org 352 microbot #test bob host-12.example.net irc.example.org bob G :1 bob",
+    b":irc.example.org 352 microbot #test carol ::1 irc.example.org carol H*+ :0 Carol",
+    b":irc.example.org 315 microbot #test :End of /WHO list.",
+]
+
+
+def make_mix(weights: Dict[int, List[bytes]], lines: int, seed: int = 1) -> List[bytes]:
+    "Draw `lines` lines from the given pools, each pool picked with its weight"
+    rng = random.Random(seed)
+    pools = list(weights.values())
+    pool_weights = list(weights.keys())
+    return [rng.choice(rng.choices(pools, pool_weights)[0]) for _ in range(lines)]
+
+
+MIXES = {
+    "channel": {90: CHANNEL_TRAFFIC, 10: SERVER_REPLIES},
+    "who-heavy": {30: CHANNEL_TRAFFIC, 10: SERVER_REPLIES, 60: WHO_REPLIES},
+}
+
+
+def parse_time(module: ModuleType, lines: List[bytes], prefix: bool) -> float:
+    "Parse every line, like a command handler that looks at the command and arguments and maybe the prefix"
+    Command = module.Command
+    start = time.perf_counter()
+    if prefix:
+        for line in lines:
+            Command(line).prefix
+    else:
+        for line in lines:
+            Command(line)
+    return time.perf_counter() - start
+
+
+def lines_per_second(modules: Dict[str, ModuleType], lines: List[bytes], prefix: bool,
+                     repeat: int) -> Dict[str, float]:
+    "Best of `repeat` runs for every module. The modules take turns, so they all run under the same conditions"
+    best = {name: float("inf") for name in modules}
+    for _ in range(repeat):
+        for name, module in modules.items():
+            best[name] = min(best[name], parse_time(module, lines, prefix))
+    return {name: len(lines) / seconds for name, seconds in best.items()}
+
+
+def parse_all(module: ModuleType, lines: List[bytes], prefix: bool) -> List[object]:
+    parsed = [module.Command(line) for line in lines]
+    if prefix:
+        for command in parsed:
+            command.prefix
+    return parsed
+
+
+def allocations_per_line(module: ModuleType, lines: List[bytes], prefix: bool) -> float:
+    "Memory blocks still allocated per parsed line while the parsed commands are kept around"
+    before = sys.getallocatedblocks()
+    kept = parse_all(module, lines, prefix)
+    blocks = sys.getallocatedblocks() - before - 1  # the list holding them
+    del kept
+    return blocks / len(lines)
+
+
+def bytes_per_line(module: ModuleType, lines: List[bytes], prefix: bool) -> float:
+    "Bytes still allocated per parsed line while the parsed commands are kept around"
+    tracemalloc.start()
+    kept = parse_all(module, lines, prefix)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return size / len(lines)
+
+
+def load(path: str) -> ModuleType:
+    "Load another command.py, with its own directory searched first for the modules it imports"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+    spec = importlib.util.spec_from_file_location("compared_command", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lines", help="lines per mix", type=int, default=50000)
+    parser.add_argument("--repeat", help="timing runs per benchmark, the best one is reported",
+                        type=int, default=10)
+    parser.add_argument("--compare", help="path to another command.py to benchmark against")
+    args = parser.parse_args()
+
+    modules = {"current": command}
+    if args.compare:
+        modules["compared"] = load(args.compare)
+
+    for mix_name, weights in MIXES.items():
+        lines = make_mix(weights, args.lines)
+        for access_name, prefix in (("dispatch", False), ("prefix", True)):
+            speeds = lines_per_second(modules, lines, prefix, args.repeat)
+            for module_name, module in modules.items():
+                print(f"{mix_name:10} {access_name:9} {module_name:9} "
+                      f"{speeds[module_name]:12,.0f} lines/s "
+                      f"{allocations_per_line(module, lines, prefix):6.1f} blocks/line "
+                      f"{bytes_per_line(module, lines, prefix):7.0f} bytes/line")
+            if "compared" in speeds:
+                print(f"{'':30} speedup {speeds['current'] / speeds['compared']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
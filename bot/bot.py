@@ -1,10 +1,45 @@
 # TODO: Error handling in general. Currently this class just kinda hopes for the best and lets the language or the socket API throw all the errors
-# TODO: Do we want to support having the bot watch multiple channels at once? Currently it can only do one.
 
+import select
 import socket
+import time
 from types import TracebackType
-from typing import Dict, Iterable, Optional, Set, Type
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Type
+import cache
 import command
+import outbound
+import plugins
+import roster
+
+# How much to ask the socket for at once
+RECV_SIZE = 2 ** 12
+# The longest partial line kept while waiting for the rest of it. IRC lines are at most 512 bytes,
+# but some servers send longer ones, so this leaves some room
+MAX_BUFFER = 2 ** 13
+# The longest line that may be sent, including the CRLF
+MAX_LINE = 512
+# Room left in PRIVMSGs for the nick!user@host prefix the server adds when relaying them
+PREFIX_ALLOWANCE = 100
+
+
+def split_text(text: bytes, size: int) -> Iterator[bytes]:
+    """
+    Split text into pieces of at most `size` bytes, at spaces when possible, and never in the middle of a UTF-8
+    character
+    """
+    while len(text) > size:
+        end = text.rfind(b" ", 0, size + 1)
+        if end <= 0:
+            end = size
+            # Back up over UTF-8 continuation bytes, which look like 0b10xxxxxx
+            while end > 0 and text[end] & 0xC0 == 0x80:
+                end -= 1
+            if end == 0:
+                end = size
+        yield text[:end]
+        text = text[end:].lstrip(b" ")
+    if text:
+        yield text
 
 
 class Bot:
@@ -12,23 +47,44 @@ class Bot:
     _name: bytes
     _socket: socket.SocketIO
     _server_name: Optional[bytes]
-    _channel: Optional[bytes]
-    _users_on_channel: Set[bytes]
+    _roster: roster.Roster
     _debug: bool
+    _buffer: bytes  # the start of a line whose end hasn't been received yet
+    _discarding: bool  # whether the line being received is too long, and is being dropped
+    _lines_processed: int
+    _outbound: outbound.OutboundQueue
+    _triggers: plugins.Registry
+    response_cache: cache.ResponseCache
 
-    def __init__(self, name: bytes, port: int, ipv6: bool = True, debug: bool = False) -> None:
+    def __init__(self, name: bytes, port: int, ipv6: bool = True, debug: bool = False,
+                 send_rate: float = 0.5, send_burst: int = 5, triggers: Optional[plugins.Registry] = None,
+                 cache_size: int = 256) -> None:
+        """
+        Outgoing lines are rate limited: `send_burst` of them can go out at once, then `send_rate` per second.
+        `triggers` are the bot commands this bot responds to, `plugins.registry` by default, and up to `cache_size`
+        of their replies are kept around for the ones that allow it
+        """
         self._name = name
         self._port = port
         self._debug = debug
-        self._users_on_channel = set()
+        self._server_name = None
+        self._outbound = outbound.OutboundQueue(send_rate, send_burst)
+        self._roster = roster.Roster()
+        self._triggers = triggers if triggers is not None else plugins.registry
+        self.response_cache = cache.ResponseCache(cache_size)
+        self._buffer = b""
+        self._discarding = False
+        self._lines_processed = 0
 
-        addr_family = socket.AF_INET6 if ipv6 else socket.AF_INET
-        self._socket = socket.socket(addr_family)
+        self._open_socket(socket.AF_INET6 if ipv6 else socket.AF_INET)
 
         if debug:
             print(
                 f"started bot in debug mode: name: {name.decode()}, port: {port}, using " + "ipv6" if ipv6 else "ipv4")
 
+    def _open_socket(self, addr_family: socket.AddressFamily) -> None:
+        self._socket = socket.socket(addr_family)
+
     def __enter__(self) -> "Bot":
         return self
 
@@ -46,6 +102,8 @@ class Bot:
                           "terminated, and the socket may not have been closed\n"
                           f"\tError: {e}")
 
+        if self._debug:
+            print(f"reply cache: {self.response_cache}")
         if isinstance(exc_value, OSError):
             if self._debug:
                 print(f"An OS Error has occurred. This bot will now shut down.\n"
@@ -62,113 +120,307 @@ class Bot:
         Establish a connection to the specified IRC server, sending the NICK and USER messages
         """
         self._socket.connect((server, self._port))
+        self._register()
+
+    def _register(self) -> None:
         self._send(b"NICK %s" % self._name)
         self._send(b"USER %s 0 * :%s" % (self._name, self._name))
 
     def join_channel(self, channel: bytes) -> None:
         """
-        Join the specified channel, sending an appropriate JOIN message
+        Join the specified channel, sending an appropriate JOIN message. The bot can be on any number of channels
         """
-        self._send(b"JOIN #%s" % channel)
-        self._channel = channel
-        self._send(b"WHO #%s" % channel)
+        name = b"#%s" % channel
+        self._roster.add_channel(name)
+        self._send(b"JOIN %s" % name)
+        self._send(b"WHO %s" % name)
 
-    def send_channel_message(self, message: str) -> None:
+    def channels(self) -> Iterable[roster.Channel]:
         """
-        Send a public message to all users on the channel this bot is on
+        The channels this bot is on
         """
-        self._send(b"PRIVMSG #%s :%r" % (self._channel, message))
+        return self._roster.channels.values()
+
+    def get_channel(self, name: bytes) -> Optional[roster.Channel]:
+        """
+        What the bot knows about a channel, by its name including the #, or `None` if the bot isn't on it
+        """
+        return self._roster.get_channel(name)
+
+    def get_user(self, nick: bytes) -> Optional[roster.User]:
+        """
+        What the bot knows about someone on one of its channels, or `None` if they aren't on any of them
+        """
+        return self._roster.get_user(nick)
+
+    def users_on(self, channel: bytes) -> Iterator[roster.User]:
+        """
+        Everyone on a channel, named including the #, as last heard from the server
+        """
+        return self._roster.members(channel)
+
+    def send_channel_message(self, message: str, channel: Optional[bytes] = None) -> None:
+        """
+        Send a public message to all users on a channel, named including the #.
+        If no channel is given, the message is sent to every channel this bot is on
+        """
+        targets = [channel] if channel is not None else [joined.name for joined in self.channels()]
+        for target in targets:
+            self._send_privmsg(target, message.encode())
+
+    @property
+    def triggers(self) -> plugins.Registry:
+        "The bot commands this bot responds to"
+        return self._triggers
+
+    @property
+    def lines_processed(self) -> int:
+        "How many lines have been received and parsed so far"
+        return self._lines_processed
+
+    @property
+    def bytes_buffered(self) -> int:
+        "How many bytes of a partially received line are waiting for the rest of it"
+        return len(self._buffer)
 
     def receive_forever(self) -> None:
         """
-        Enter an infinite loop of receiving commands and handling them
+        Receive commands and handle them until the server closes the connection
+        """
+        for command in self.receive_commands():
+            self._command_handler(command)
+
+    def receive_commands(self) -> Iterator[command.Command]:
+        """
+        Receive data from the server and yield every command in it as soon as it is complete.
+        Returns once the server closes the connection
         """
-        buffer = b""
         while True:
-            data = self._socket.recv(2 ** 10)
-            buffer += data
-            self._handle_command(buffer)
+            # Wake up in time to send whatever the rate limiter is holding back
+            readable, _, _ = select.select([self._socket], [], [], self._outbound.delay(time.monotonic()))
+            if not readable:
+                self._flush()
+                continue
+            data = self._socket.recv(RECV_SIZE)
+            if not data:
+                if self._debug:
+                    print("the server closed the connection")
+                return
+            yield from self._parse_commands(data)
 
     def quit(self, message: str) -> None:
         """
         Quit the server and close the socket
         """
-        self._users_on_channel.clear()
-        self._send(b"QUIT %r" % message)
+        self._roster.clear()
+        # Anything still held back by the rate limiter is dropped, the QUIT itself goes out right away
+        self._write(b"QUIT :%s\r\n" % message.encode())
         self._socket.close()
 
-    def _handle_command(self, buffer: bytes) -> None:
-        commands = Bot._parse_command(buffer)
-        for command in commands:
-            self._command_handler(command)
-
-    @staticmethod
-    def _parse_command(buffer: bytes) -> Iterable[command.Command]:
-        lines = buffer.split(b"\r\n")
+    def _parse_commands(self, data: bytes) -> Iterator[command.Command]:
+        lines = (self._buffer + data).split(b"\r\n")
         # We'll process all lines but the last, because it may be a partial message the rest of which
         # is still on its way. Sockets aren't magically aware that we're using them to communicate via the
         # IRC protocol, so they may split data that conceptually goes together
-        buffer = lines[-1]
-        lines = lines[:-1]
-        # Also, there could be empty lines, which the IRC RFC specifies must be ignored
-        return map(lambda line: command.Command(line), filter(lambda line: line, lines))
-
-    def _command_handler(self, command: command.Command) -> None:
-        def ping() -> None:
-            if len(command.args) < 1:
-                self._reply(b"409 %s :No origin specified" % self._name)
-                return
-            self._send(b"PONG %s :%s" % (self._server_name, command.args[0]))
-
-        def join() -> None:
-            assert command.prefix is not None
-            nick = command.prefix.nick
-            self._users_on_channel.add(nick)
-            print(self._users_on_channel)
-
-        def part() -> None:
-            assert command.prefix is not None
-            nick = command.prefix.nick
-            self._users_on_channel.remove(nick)
-
-        def quit() -> None:
-            assert command.prefix is not None
-            nick = command.prefix.nick
-            self._users_on_channel.remove(nick)
-
-        def rpl_myinfo() -> None:
-            client_name, server_name, version, user_modes, channel_modes = command.args
-            self._server_name = server_name
-
-        def rpl_whoreply() -> None:
-            _, channel, name, host, server, nick, hg, star, at_plus, hopcount, realname = command.args
-
-        handlers = {
-            b"PING": ping,
-            b"JOIN": join,
-            b"PART": part,
-            b"QUIT": quit,
-            b"004": rpl_myinfo,
-            b"352": rpl_whoreply,
-        }
-
-        if self._debug:
-            print(f"in: {command}")
+        self._buffer = lines.pop()
+        if self._discarding:
+            if lines:
+                lines[0] = b""  # That's the end of the line being dropped
+                self._discarding = False
+            else:
+                self._buffer = b""
+        if len(self._buffer) > MAX_BUFFER:
+            if self._debug:
+                print(f"dropping a line longer than {MAX_BUFFER} bytes")
+            self._buffer = b""
+            self._discarding = True
+        for line in lines:
+            # Also, there could be empty lines, which the IRC RFC specifies must be ignored
+            if not line:
+                continue
+            self._lines_processed += 1
+            try:
+                yield command.Command(line)
+            except command.Error:
+                if self._debug:
+                    print(f"ignoring malformed line: {line!r}")
 
+    def _command_handler(self, received: command.Command) -> None:
+        # The prefix is only parsed when a handler first looks at it, so a malformed one surfaces here
         try:
-            handlers[command.command]()
-        except KeyError:
-            pass  # Ignore unknown commands and replies
+            if self._debug:
+                print(f"in: {received}")
+
+            handler = self._handlers.get(received.command)
+            if handler is not None:  # Ignore unknown commands and replies
+                handler(self, received)
+        except command.Error:
+            if self._debug:
+                print(f"ignoring malformed line: {received.command!r} {received.args!r}")
+
+    def _ping(self, command: command.Command) -> None:
+        if len(command.args) < 1:
+            self._reply(b"409 %s :No origin specified" % self._name)
+            return
+        if self._server_name is None:
+            self._send(b"PONG :%s" % command.args[0], outbound.URGENT)
+        else:
+            self._send(b"PONG %s :%s" % (self._server_name, command.args[0]), outbound.URGENT)
+
+    def _join(self, command: command.Command) -> None:
+        assert command.prefix is not None
+        prefix = command.prefix
+        if prefix.nick == self._name:
+            self._roster.add_channel(command.args[0])
+        self._roster.join(prefix.nick, command.args[0], prefix.name, prefix.host)
+
+    def _part(self, command: command.Command) -> None:
+        assert command.prefix is not None
+        if command.prefix.nick == self._name:
+            self._roster.remove_channel(command.args[0])
+        else:
+            self._roster.part(command.prefix.nick, command.args[0])
+
+    def _kick(self, command: command.Command) -> None:
+        if len(command.args) < 2:
+            return
+        channel, nick = command.args[0], command.args[1]
+        if nick == self._name:
+            self._roster.remove_channel(channel)
+        else:
+            self._roster.part(nick, channel)
+
+    def _quit(self, command: command.Command) -> None:
+        assert command.prefix is not None
+        self._roster.quit(command.prefix.nick)
+
+    def _nick(self, command: command.Command) -> None:
+        assert command.prefix is not None
+        if command.prefix.nick == self._name:
+            self._name = command.args[0]
+        self._roster.rename(command.prefix.nick, command.args[0])
+
+    def _privmsg(self, command: command.Command) -> None:
+        if command.prefix is None or len(command.args) < 2:
+            return
+        text = command.args[1].decode(errors="replace")
+        found = self._triggers.match(text)
+        if found is None:
+            return
+        trigger, args, match = found
+        if not trigger.ready(command.prefix.nick, time.monotonic()):
+            return
+        self._run_trigger(trigger, plugins.Message(command.prefix.nick, command.args[0], text, args, match))
+
+    def _run_trigger(self, trigger: plugins.Trigger, message: plugins.Message) -> None:
+        reply = self._cached_reply(trigger, message)
+        if reply is None:
+            reply = self._store_reply(trigger, message, trigger.handler(self, message))
+        if reply:
+            self._send_privmsg(message.reply_to, reply)
+
+    def _reply_key(self, trigger: plugins.Trigger, message: plugins.Message) -> Any:
+        return trigger.name, cache.normalize(message.args if message.match is None else message.text)
+
+    def _cached_reply(self, trigger: plugins.Trigger, message: plugins.Message) -> Optional[bytes]:
+        if not trigger.cache_ttl:
+            return None
+        return self.response_cache.get(self._reply_key(trigger, message), time.monotonic())
+
+    def _store_reply(self, trigger: plugins.Trigger, message: plugins.Message, reply: Optional[str]) -> bytes:
+        "Encode a handler's reply, keeping it for next time if the trigger allows that"
+        encoded = reply.encode() if reply else b""
+        if trigger.cache_ttl:
+            self.response_cache.put(self._reply_key(trigger, message), encoded, trigger.cache_ttl,
+                                    time.monotonic())
+        return encoded
+
+    def _topic(self, command: command.Command) -> None:
+        channel = self._roster.get_channel(command.args[0])
+        if channel is not None:
+            channel.topic = command.args[1] if len(command.args) > 1 else None
+
+    def _mode(self, command: command.Command) -> None:
+        if len(command.args) < 2:
+            return
+        channel = self._roster.get_channel(command.args[0])
+        if channel is not None:
+            channel.apply_modes(command.args[1], command.args[2:])
+
+    def _rpl_channelmodeis(self, command: command.Command) -> None:
+        channel = self._roster.get_channel(command.args[1])
+        if channel is not None:
+            channel.modes.clear()
+            channel.apply_modes(command.args[2], command.args[3:])
+
+    def _rpl_topic(self, command: command.Command) -> None:
+        channel = self._roster.get_channel(command.args[1])
+        if channel is not None:
+            channel.topic = command.args[2]
+
+    def _rpl_namreply(self, command: command.Command) -> None:
+        # <client> <symbol> <channel> :<names>
+        if len(command.args) == 4:
+            self._roster.names(command.args[2], command.args[3].split())
+
+    def _rpl_endofnames(self, command: command.Command) -> None:
+        self._roster.end_of_names(command.args[1])
+
+    def _rpl_myinfo(self, command: command.Command) -> None:
+        client_name, server_name, version, user_modes, channel_modes = command.args
+        self._server_name = server_name
+
+    def _rpl_whoreply(self, command: command.Command) -> None:
+        _, channel, name, host, server, nick, hg, star, at_plus, hopcount, realname = command.args
+        self._roster.who(b"#%s" % channel, nick, name, host, realname, at_plus)
+
+    # Built once, when the class is. Subclasses like AsyncBot share it
+    _handlers: Dict[bytes, Callable[["Bot", command.Command], Any]] = {
+        b"PING": _ping,
+        b"JOIN": _join,
+        b"PART": _part,
+        b"QUIT": _quit,
+        b"KICK": _kick,
+        b"NICK": _nick,
+        b"PRIVMSG": _privmsg,
+        b"TOPIC": _topic,
+        b"MODE": _mode,
+        b"004": _rpl_myinfo,
+        b"324": _rpl_channelmodeis,
+        b"332": _rpl_topic,
+        b"352": _rpl_whoreply,
+        b"353": _rpl_namreply,
+        b"366": _rpl_endofnames,
+    }
 
     def _reply(self, message: bytes) -> None:
         self._print_debug(message)
-        self._socket.sendall(b":%s %s\r\n" % (self._server_name, message))
+        self._queue(b":%s %s\r\n" % (self._server_name, message), outbound.NORMAL)
 
-    def _send(self, message: bytes) -> None:
+    def _send(self, message: bytes, lane: int = outbound.NORMAL) -> None:
         self._print_debug(message)
-        self._socket.sendall(b"%s\r\n" % message)
+        self._queue(b"%s\r\n" % message, lane)
+
+    def _send_privmsg(self, target: bytes, text: bytes) -> None:
+        "Send a PRIVMSG, split over as many lines as it takes to stay under the line length limit"
+        start = b"PRIVMSG %s :" % target
+        room = MAX_LINE - len(start) - len(b"\r\n") - PREFIX_ALLOWANCE
+        for chunk in split_text(text, room):
+            self._send(start + chunk, outbound.BULK)
+
+    def _queue(self, line: bytes, lane: int) -> None:
+        self._outbound.push(line, lane)
+        self._flush()
+
+    def _flush(self) -> None:
+        "Send every line the rate limiter allows right now, in a single write"
+        data = self._outbound.pop_ready(time.monotonic())
+        if data:
+            self._write(data)
+
+    def _write(self, data: bytes) -> None:
+        self._socket.sendall(data)
 
     def _print_debug(self, message: bytes):
         if self._debug:
-            channel = getattr(self, "_channel", b"{not on any channel}")
-            print(f"out: #{channel.decode()}: {message.decode()}")
+            print(f"out: {message.decode()}")
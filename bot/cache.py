@@ -0,0 +1,67 @@
+"""
+This module contains the cache for bot command replies, so that a popular command asked for over and over again
+in a busy channel is only worked out once in a while
+"""
+
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
+
+
+class ResponseCache:
+    """
+    Encoded replies, each kept for its own time to live, and at most `size` of them.
+    When it's full, the least recently used reply makes room
+    """
+    _size: int
+    _entries: "OrderedDict[Hashable, Tuple[float, bytes]]"  # key -> (expiry time, reply)
+    hits: int
+    misses: int
+    evictions: int
+
+    def __init__(self, size: int = 256) -> None:
+        self._size = size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, now: float) -> Optional[bytes]:
+        "The cached reply, which may be empty if there was nothing to say, or `None` if there isn't one"
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= now:
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: Hashable, reply: bytes, ttl: float, now: float) -> None:
+        if self._size <= 0:
+            return
+        self._entries[key] = (now + ttl, reply)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __str__(self) -> str:
+        return (f"{len(self._entries)}/{self._size} replies cached, {self.hits} hits, {self.misses} misses "
+                f"({self.hit_rate:.0%} hit rate), {self.evictions} evictions")
+
+
+def normalize(args: str) -> str:
+    "Arguments that only differ in spacing get the same reply"
+    return " ".join(args.split())
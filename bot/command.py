@@ -2,8 +2,7 @@
 This module contains the data structures to represent an IRC command
 """
 
-from typing import Optional, Sequence, Tuple
-import re
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
 
 class Error(Exception):
@@ -22,34 +21,24 @@ class InvalidArgumentsError(Error):
     "A valid command was given, but its arguments were invalid"
 
 
-# Anything but an !, one or more, capturing group
-nick = br"([^!]+)"
-# an !, Anything but an @ sign, one or more, capturing group. The whole thing is optional
-name = br"(?:!([^@]+))?"
-# an @, Anything at all, one or more, capturing group. The whole thing is optional
-host = br"(?:@(.+))?"
-PREFIX_REGEX = re.compile(b"%s%s%s" % (nick, name, host))
-
-
 class Prefix:
+    __slots__ = ("nick", "name", "host")
     nick: bytes
     name: Optional[bytes]
     host: Optional[bytes]
 
     def __init__(self, input: bytes) -> None:
-        match = PREFIX_REGEX.match(input)
-        if match:
-            self.nick = match[1]
-            try:
-                self.name = match[2]
-            except KeyError:
-                self.name = None
-            try:
-                self.host = match[3]
-            except KeyError:
-                self.host = None
-        else:
+        """
+        Parse a `nick[!name][@host]` prefix, without the leading `:`
+        Raises `InvalidPrefixError` if there is no nick
+        """
+        nick, _, host = input.partition(b"@")
+        nick, _, name = nick.partition(b"!")
+        if not nick:
             raise InvalidPrefixError
+        self.nick = nick
+        self.name = name or None
+        self.host = host or None
 
     def __str__(self) -> str:
         if self.name:
@@ -63,49 +52,63 @@ class Prefix:
         return f"{self.nick.decode()}{name}{host}"
 
 
+# Parsed prefixes and message heads by their raw bytes. Channel traffic keeps coming from the same few senders to
+# the same few targets, so most of them are parsed once. Neither is ever modified after parsing, so one object can
+# be shared by every command with the same one
+_prefixes: Dict[bytes, Prefix] = {}
+_heads: Dict[bytes, Tuple[Optional[bytes], bytes, Tuple[bytes, ...]]] = {}
+MAX_CACHED = 1024
+
+
 class Command:
     "A single IRC command"
-    prefix: Optional[Prefix]
+    __slots__ = ("command", "args", "_prefix", "_trailing")
     command: bytes
     args: Sequence[bytes]
+    _prefix: Union[None, bytes, Prefix]  # raw bytes until the prefix is first accessed
     _trailing: bool  # used by __str__
 
     def __init__(self, input: bytes) -> None:
         """
         Create a command by parsing an IRC command bytestring
-        Raises `EmptyPrefixError` if the string starts with `:` but has no actual prefix, and
-        `MissingCommandError` if the string doesn't have a command
+        Raises `InvalidPrefixError` if the string starts with `:` but has no actual prefix, and
+        `MissingCommandError` if the string doesn't have a command.
+        The rest of the prefix is only parsed when `prefix` is first accessed, so an invalid one raises
+        `InvalidPrefixError` from there instead
         """
-        prefix: Optional[Prefix]
-        if input.startswith(b":"):
+        # Everything before the first " :" is space separated, and everything after it is the trailing argument.
+        # A leading ":" is never preceded by a space, so the prefix ends up in the first part as well
+        head, separator, trailing = input.partition(b" :")
+        parsed = _heads.get(head)
+        if parsed is None:
+            parsed = _parse_head(head)
+            if parsed[1] != b"352":  # every WHO reply has a head of its own
+                if len(_heads) >= MAX_CACHED:
+                    _heads.clear()
+                _heads[head] = parsed
+        prefix, self.command, args = parsed
+        self._prefix = prefix
+
+        if self.command == b"352":  # RPL_WHOREPLY
             self._trailing = True
-            # There definitely is a first part, which is at least the :
-            parts = iter(input.split(maxsplit=1))
-
-            # And if it's _only_ the :, then there isn't an actual prefix
-            prefix = Prefix(next(parts)[1:])
-
-            # Anything left, if anything exists, is still to parse
-            input = next(parts, b"")
-        else:
-            prefix = None
-
-        parts = iter(input.split(maxsplit=1))
-        try:
-            command = next(parts)
-        except StopIteration:
-            raise MissingCommandError
-
-        special_parsers = {
-            b"352": self._parse_whoreply_args  # RPL_WHOREPLY
-        }
-
-        self.prefix = prefix
-        self.command = command
-        try:
-            self.args = special_parsers[command](next(parts))
-        except KeyError:
-            self.args = self._parse_most_args(next(parts))
+            self.args = _parse_whoreply_args(input.split(None, 2 if prefix else 1)[-1])
+            return
+
+        self._trailing = bool(separator)
+        self.args = [*args, trailing] if separator else list(args)
+
+    @property
+    def prefix(self) -> Optional[Prefix]:
+        prefix = self._prefix
+        if prefix.__class__ is bytes:
+            parsed = _prefixes.get(prefix)
+            if parsed is None:
+                parsed = Prefix(prefix)
+                if len(_prefixes) >= MAX_CACHED:
+                    _prefixes.clear()
+                _prefixes[prefix] = parsed
+            prefix = self._prefix = parsed
+        return prefix
 
     def __str__(self) -> str:
         prefix = f":{self.prefix}" if self.prefix else ""
@@ -123,56 +126,57 @@ class Command:
             pass  # Apparently there were no arguments, so we don't have to worry about stringifying them
         return out
 
-    def _parse_most_args(self, args: bytes) -> Sequence[bytes]:
-        try:
-            if args.startswith(b":"):
-                self._trailing = True
-                arguments = [args[1:]]
-            else:
-                self._trailing = False
-                args_and_trailing = args.split(b" :", 1)
-                arguments = args_and_trailing[0].split()
-                try:
-                    arguments.append(args_and_trailing[1])
-                    self._trailing = True
-                except:  # This fails if there aren't trailing arguments, in which case we have nothing to append
-                    pass
-        except StopIteration:
-            arguments = []
-        return arguments
-
-    # RPL_WHOREPLY is incompatible with the above parser, and in fact violates the IRC message format
-    # by having a : before something other than the last parameter (specifically, it's before the second to last)
-    # Also, it contains the hostname, which _could_ start with :, for example by being an ipv6 address starting with ::
-    # Because this is unacceptable, a more specialized parsing function is necessary
-    def _parse_whoreply_args(self, input: bytes) -> Sequence[bytes]:
-        import parsers
-        from parsers import whitespace, one_of, optional, char, ParseError
-
-        def text(input: bytes) -> Tuple[bytes, bytes]:
-            word, rest = parsers.text(input)
-            _, rest = whitespace(rest)
-            return word, rest
 
-        try:
-            nick, rest = text(input)
-            _, rest = char(rest, b"#")
-            channel, rest = text(rest)
-            name, rest = text(rest)
-            host, rest = text(rest)
-            server, rest = text(rest)
-            nick, rest = text(rest)
-            hg, rest = one_of(rest, [b"H", b"G"])
-            star, rest = optional(rest, lambda x: char(x, b"*"))
-            at_plus, rest = optional(rest, lambda x: one_of(x, [b"@", b"+"]))
-            _, rest = whitespace(rest)
-            _, rest = char(rest, b":")
-            hopcount, rest = text(rest)
-            _, rest = whitespace(rest)
-            realname, rest = text(rest)
-            if rest:
-                raise InvalidArgumentsError
-        except ParseError:
-            raise InvalidArgumentsError
-        return [nick, channel, name, host, server, nick,
-                hg, star if star else b"", at_plus if at_plus else b"", hopcount, realname]
+def _parse_head(head: bytes) -> Tuple[Optional[bytes], bytes, Tuple[bytes, ...]]:
+    "Split everything before the trailing argument into the raw prefix, the command and the other arguments"
+    args = head.split()
+    if head[:1] == b":":
+        prefix = args[0][1:]
+        if not prefix:
+            raise InvalidPrefixError
+        if len(args) < 2:
+            raise MissingCommandError
+        return prefix, args[1], tuple(args[2:])
+    if not args:
+        raise MissingCommandError
+    return None, args[0], tuple(args[1:])
+
+
+# RPL_WHOREPLY is incompatible with the general parser, and in fact violates the IRC message format
+# by having a : before something other than the last parameter (specifically, it's before the second to last)
+# Also, it contains the hostname, which _could_ start with :, for example by being an ipv6 address starting with ::
+# Because this is unacceptable, a more specialized parsing function is necessary
+def _parse_whoreply_args(input: bytes) -> List[bytes]:
+    """
+    Parse `<client> #<channel> <user> <host> <server> <nick> <H|G>[*][@|+] :<hopcount> <realname>`
+    into `[client, channel, user, host, server, nick, hg, star, at_plus, hopcount, realname]`, with empty
+    bytestrings standing in for the missing optional flags
+    """
+    fields = input.split(None, 7)
+    if len(fields) < 8:
+        raise InvalidArgumentsError
+    client, channel, name, host, server, nick, flags, rest = fields
+    if not channel.startswith(b"#") or not rest.startswith(b":"):
+        raise InvalidArgumentsError
+
+    hg = flags[:1]
+    if hg != b"H" and hg != b"G":
+        raise InvalidArgumentsError
+    position = 1
+    star = b""
+    if flags[position:position + 1] == b"*":
+        star = b"*"
+        position += 1
+    at_plus = flags[position:position + 1]
+    if at_plus == b"@" or at_plus == b"+":
+        position += 1
+    else:
+        at_plus = b""
+    if position != len(flags):
+        raise InvalidArgumentsError
+
+    hop_and_realname = rest[1:].split(None, 1)
+    if len(hop_and_realname) != 2:
+        raise InvalidArgumentsError
+    hopcount, realname = hop_and_realname
+    return [client, channel[1:], name, host, server, nick, hg, star, at_plus, hopcount, realname]
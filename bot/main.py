@@ -1,13 +1,33 @@
 #!/usr/bin/env python3
 
+import asyncio
+import async_bot
+import basic_commands  # registers !hello, !slap and !help
 import bot
 import argparse
+from typing import List, NamedTuple
 
 DEFAULT_HOST = "fc00:1337::17"
 DEFAULT_PORT = 6667
 DEFAULT_NAME = "microbot"
 DEFAULT_CHANNEL = "test"
 
+
+class Network(NamedTuple):
+    host: bytes
+    port: int
+    channels: List[bytes]
+
+
+def network(value: str) -> Network:
+    "Parse HOST/PORT/CHANNEL[,CHANNEL...]. Slashes, because ipv6 addresses are full of colons"
+    try:
+        host, port, channels = value.split("/")
+        return Network(host.encode(), int(port), [channel.encode() for channel in channels.split(",")])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected HOST/PORT/CHANNEL[,CHANNEL...], got {value}")
+
+
 parser = argparse.ArgumentParser()
 parser.add_argument(
     "--host", help="set the server to connect to", default=DEFAULT_HOST)
@@ -16,20 +36,58 @@ parser.add_argument("--port", help="set the port to use",
 parser.add_argument(
     "--name", help="set the name of the bot", default=DEFAULT_NAME)
 parser.add_argument(
-    "--channel", help="set the channel that the bot will join", default=DEFAULT_CHANNEL)
+    "--channel", help="set a channel that the bot will join. Can be given more than once", action="append")
+parser.add_argument("--network", help="connect to another server as well, joining the listed channels there. "
+                    "Can be given more than once. All the connections share one asyncio event loop",
+                    type=network, action="append", default=[], metavar="HOST/PORT/CHANNEL[,CHANNEL...]")
+parser.add_argument("--send-rate", help="lines per second the bot may send once its burst is used up. "
+                    "Defaults to 0.5", type=float, default=0.5)
+parser.add_argument("--send-burst", help="lines the bot may send at once. Defaults to 5", type=int, default=5)
+parser.add_argument("--cache-size", help="replies to bot commands kept for reuse. Defaults to 256",
+                    type=int, default=256)
 parser.add_argument("--debug", help="enable debug mode", action="store_true")
 parser.add_argument(
     "--ip-version", help='ip version to use. Defaults to "ipv6"', choices=["ipv4", "ipv6"], default="ipv6")
+parser.add_argument("--async", help="run the bot on an asyncio event loop, so slow commands don't hold up the "
+                    "connection", action="store_true", dest="use_async")
 
 args = parser.parse_args()
+channels = [channel.encode() for channel in args.channel or [DEFAULT_CHANNEL]]
+networks = [Network(args.host.encode(), args.port, channels)] + args.network
+greeting = (f"Hello, I am {args.name}. Try sending !hello, !slap or !help on the channel, or "
+            "sending me a private message.")
+
+
+async def run_network(network: Network) -> None:
+    async with async_bot.AsyncBot(args.name.encode(), network.port, ipv6=args.ip_version == "ipv6",
+                                  debug=args.debug, send_rate=args.send_rate, send_burst=args.send_burst,
+                                  cache_size=args.cache_size) as b:
+        await b.connect_to_server(network.host)
+        for channel in network.channels:
+            b.join_channel(channel)
+        b.send_channel_message(greeting)
+        await b.receive_forever()
+
+
+async def run_networks() -> None:
+    "Run one connection per network, all on this event loop. One of them failing doesn't stop the others"
+    results = await asyncio.gather(*map(run_network, networks), return_exceptions=True)
+    for network, result in zip(networks, results):
+        if isinstance(result, Exception):
+            print(f"the connection to {network.host.decode()} failed.\n"
+                  f"\tError: {result}")
 
 try:
-    with bot.Bot(args.name.encode(), args.port, ipv6=args.ip_version == "ipv6", debug=args.debug) as b:
-        b.connect_to_server(args.host.encode())
-        b.join_channel(args.channel.encode())
-        b.send_channel_message(f"Hello, I am {args.name}. Try sending !hello or !slap on the channel, or "
-                               "sending me a private message.")
-        b.receive_forever()
+    if args.use_async or len(networks) > 1:
+        asyncio.run(run_networks())
+    else:
+        with bot.Bot(args.name.encode(), args.port, ipv6=args.ip_version == "ipv6", debug=args.debug,
+                     send_rate=args.send_rate, send_burst=args.send_burst, cache_size=args.cache_size) as b:
+            b.connect_to_server(args.host.encode())
+            for channel in channels:
+                b.join_channel(channel)
+            b.send_channel_message(greeting)
+            b.receive_forever()
 except OSError as e:
     print(f"creating the bot failed. This program will now exit.\n"
-          "\tError: {e}")
+          f"\tError: {e}")
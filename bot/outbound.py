@@ -0,0 +1,68 @@
+"""
+This module contains the queue outgoing lines wait in, so that a bot never sends faster than the server allows
+"""
+
+from collections import deque
+from typing import Deque, List, Optional
+
+# Lanes, from the one that always goes first to the one that goes last
+URGENT = 0  # keepalive, like PONG
+NORMAL = 1  # everything needed to stay registered and on channels
+BULK = 2  # messages to channels and users
+LANES = 3
+
+
+class OutboundQueue:
+    """
+    A token bucket rate limiter with a queue per priority lane.
+    `burst` lines can go out at once, after which one more line is allowed every `1 / rate` seconds.
+    The defaults are what RFC 1459 asks of clients
+    """
+    _rate: float
+    _burst: float
+    _tokens: float
+    _updated: Optional[float]
+    _lanes: List[Deque[bytes]]
+    _queued: int
+
+    def __init__(self, rate: float = 0.5, burst: int = 5) -> None:
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = None
+        self._lanes = [deque() for _ in range(LANES)]
+        self._queued = 0
+
+    def __len__(self) -> int:
+        return self._queued
+
+    def push(self, line: bytes, lane: int = NORMAL) -> None:
+        "Queue a complete line, including its CRLF"
+        self._lanes[lane].append(line)
+        self._queued += 1
+
+    def pop_ready(self, now: float) -> bytes:
+        """
+        Take as many lines as the bucket allows right now, most urgent first, joined so that they can be sent
+        with a single write
+        """
+        self._refill(now)
+        ready = []
+        for lane in self._lanes:
+            while lane and self._tokens >= 1:
+                ready.append(lane.popleft())
+                self._tokens -= 1
+        self._queued -= len(ready)
+        return b"".join(ready)
+
+    def delay(self, now: float) -> Optional[float]:
+        "Seconds until the next queued line may be sent, or `None` if nothing is queued"
+        if not self._queued:
+            return None
+        self._refill(now)
+        return max(0.0, (1 - self._tokens) / self._rate)
+
+    def _refill(self, now: float) -> None:
+        if self._updated is not None:
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
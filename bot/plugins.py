@@ -0,0 +1,128 @@
+"""
+This module contains the plugin API for bot commands such as `!hello`.
+Plugin modules register handlers on a `Registry`, either for a trigger word, which must be the first word of a
+message, or for a regular expression. Triggers are looked up in a dictionary, so adding more of them doesn't make
+dispatching any slower, while regular expressions are only tried when no trigger matched.
+A handler is called with the bot and the `Message`, and returns the text to reply with, if any. Handlers that are
+coroutine functions are run as tasks by `async_bot.AsyncBot`.
+Handlers whose reply only depends on the trigger's arguments can be registered with a `cache_ttl`, in which case
+the bot reuses their replies for that many seconds instead of calling them again
+"""
+
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Called with the bot and the message, returns the reply
+Handler = Callable[[Any, "Message"], Any]
+
+# How many users a trigger remembers the last use of, before forgetting the ones whose cooldown is over
+MAX_REMEMBERED_USERS = 1024
+
+
+class Message:
+    "A message that set off a trigger"
+    __slots__ = ("nick", "target", "text", "args", "match")
+    nick: bytes  # who sent it
+    target: bytes  # the channel it was sent to, or the bot's nick for private messages
+    text: str
+    args: str  # the text after the trigger word
+    match: Optional["re.Match[str]"]  # for handlers registered with a regular expression
+
+    def __init__(self, nick: bytes, target: bytes, text: str, args: str,
+                 match: Optional["re.Match[str]"] = None) -> None:
+        self.nick = nick
+        self.target = target
+        self.text = text
+        self.args = args
+        self.match = match
+
+    @property
+    def is_private(self) -> bool:
+        return not self.target.startswith(b"#")
+
+    @property
+    def reply_to(self) -> bytes:
+        "Where a reply should go: the channel, or the sender of a private message"
+        return self.nick if self.is_private else self.target
+
+
+class Trigger:
+    "A registered handler, how often each user may set it off, and how long its replies may be reused"
+    __slots__ = ("name", "handler", "cooldown", "cache_ttl", "_last_used")
+    name: str
+    handler: Handler
+    cooldown: float  # seconds a user has to wait between two uses
+    cache_ttl: float  # seconds a reply is reused for the same arguments, or 0 to never reuse it
+    _last_used: Dict[bytes, float]
+
+    def __init__(self, name: str, handler: Handler, cooldown: float, cache_ttl: float = 0.0) -> None:
+        self.name = name
+        self.handler = handler
+        self.cooldown = cooldown
+        self.cache_ttl = cache_ttl
+        self._last_used = {}
+
+    def ready(self, nick: bytes, now: float) -> bool:
+        "Whether the user may use this trigger now. If they may, that counts as using it"
+        if not self.cooldown:
+            return True
+        last = self._last_used.get(nick)
+        if last is not None and now - last < self.cooldown:
+            return False
+        if len(self._last_used) >= MAX_REMEMBERED_USERS:
+            self._last_used = {user: used for user, used in self._last_used.items() if now - used < self.cooldown}
+        self._last_used[nick] = now
+        return True
+
+
+class Registry:
+    "A set of triggers and regular expressions, and the handlers they set off"
+    _triggers: Dict[str, Trigger]  # by lowercase trigger word
+    _patterns: List[Tuple["re.Pattern[str]", Trigger]]
+
+    def __init__(self) -> None:
+        self._triggers = {}
+        self._patterns = []
+
+    def command(self, word: str, cooldown: float = 0.0, cache_ttl: float = 0.0) -> Callable[[Handler], Handler]:
+        """
+        Decorator registering a handler for messages whose first word is `word`, like `!hello`
+        """
+        def register(handler: Handler) -> Handler:
+            self._triggers[word.lower()] = Trigger(word, handler, cooldown, cache_ttl)
+            return handler
+        return register
+
+    def regex(self, pattern: str, cooldown: float = 0.0, cache_ttl: float = 0.0) -> Callable[[Handler], Handler]:
+        """
+        Decorator registering a handler for messages matching `pattern` anywhere, for messages without a trigger
+        """
+        def register(handler: Handler) -> Handler:
+            self._patterns.append((re.compile(pattern), Trigger(pattern, handler, cooldown, cache_ttl)))
+            return handler
+        return register
+
+    def words(self) -> List[str]:
+        "Every trigger word, as registered"
+        return [trigger.name for trigger in self._triggers.values()]
+
+    def match(self, text: str) -> Optional[Tuple[Trigger, str, Optional["re.Match[str]"]]]:
+        """
+        Find the trigger for a message, returning it along with the text after the trigger word and the regular
+        expression match, if it was a regular expression that matched
+        """
+        word, _, args = text.strip().partition(" ")
+        trigger = self._triggers.get(word.lower())
+        if trigger is not None:
+            return trigger, args.strip(), None
+        for pattern, trigger in self._patterns:
+            found = pattern.search(text)
+            if found:
+                return trigger, text, found
+        return None
+
+
+# The registry bots use unless they're given another one
+registry = Registry()
+command = registry.command
+regex = registry.regex
@@ -0,0 +1,224 @@
+"""
+This module contains what a bot knows about the channels it's on and the users it shares them with.
+It is kept current from the replies to JOIN, NAMES and WHO, and from JOIN, PART, KICK, QUIT, NICK and MODE messages,
+so that questions like "who is on this channel" can be answered without asking the server again
+"""
+
+from typing import Dict, Iterable, Iterator, Optional, Sequence, Set
+
+# Channel modes that take a parameter when set, and the ones that also take one when unset.
+# The parameter of the list modes isn't kept, because they're ban lists and the like, not properties of the channel
+LIST_MODES = b"beI"
+KEY_MODES = b"k"
+LIMIT_MODES = b"l"
+# Channel modes given to a user, and the prefix that marks them in NAMES and WHO replies, highest rank first
+USER_MODES = b"qaohv"
+USER_PREFIXES = b"~&@%+"
+
+
+def casefold(name: bytes) -> bytes:
+    "Nicks and channel names are case insensitive"
+    return name.lower()
+
+
+def sort_prefixes(prefixes: Iterable[int]) -> bytes:
+    "Put user prefixes in order of rank, so the first one is always the highest"
+    return bytes(prefix for prefix in USER_PREFIXES if prefix in prefixes)
+
+
+def split_prefixes(name: bytes) -> Sequence[bytes]:
+    "Split `@+nick` as found in a NAMES reply into `[b\"@+\", b\"nick\"]`"
+    start = 0
+    while start < len(name) and name[start] in USER_PREFIXES:
+        start += 1
+    return [name[:start], name[start:]]
+
+
+class User:
+    "Someone on at least one of the bot's channels"
+    __slots__ = ("nick", "user", "host", "realname", "channels")
+    nick: bytes
+    user: Optional[bytes]
+    host: Optional[bytes]
+    realname: Optional[bytes]
+    channels: Set[bytes]  # casefolded names of the channels shared with the bot
+
+    def __init__(self, nick: bytes) -> None:
+        self.nick = nick
+        self.user = None
+        self.host = None
+        self.realname = None
+        self.channels = set()
+
+
+class Channel:
+    "What a bot knows about one of the channels it's on"
+    __slots__ = ("name", "users", "topic", "modes", "_names")
+    name: bytes  # including the #
+    users: Dict[bytes, bytes]  # casefolded nick -> that user's prefixes on this channel, like b"@" or b""
+    topic: Optional[bytes]
+    modes: Set[int]  # the flags that are set, as byte values
+    _names: Optional[Dict[bytes, bytes]]  # members listed by a NAMES reply that hasn't ended yet
+
+    def __init__(self, name: bytes) -> None:
+        self.name = name
+        self.users = {}
+        self.topic = None
+        self.modes = set()
+        self._names = None
+
+    def apply_modes(self, modes: bytes, params: Sequence[bytes]) -> None:
+        """
+        Apply a MODE change such as `+nt-s+o nick`, skipping over the parameters of modes that take one
+        """
+        params = iter(params)
+        adding = True
+        for mode in modes:
+            if mode == ord("+"):
+                adding = True
+            elif mode == ord("-"):
+                adding = False
+            elif mode in USER_MODES:
+                nick = casefold(next(params, b""))
+                if nick in self.users:
+                    prefix = USER_PREFIXES[USER_MODES.index(mode)]
+                    prefixes = set(self.users[nick])
+                    if adding:
+                        prefixes.add(prefix)
+                    else:
+                        prefixes.discard(prefix)
+                    self.users[nick] = sort_prefixes(prefixes)
+            elif mode in LIST_MODES:
+                next(params, None)
+            else:
+                if mode in KEY_MODES or (adding and mode in LIMIT_MODES):
+                    next(params, None)
+                if adding:
+                    self.modes.add(mode)
+                else:
+                    self.modes.discard(mode)
+
+
+class Roster:
+    "The bot's channels, and every user on them, indexed by casefolded name"
+    channels: Dict[bytes, Channel]
+    users: Dict[bytes, User]
+
+    def __init__(self) -> None:
+        self.channels = {}
+        self.users = {}
+
+    def get_channel(self, name: bytes) -> Optional[Channel]:
+        return self.channels.get(casefold(name))
+
+    def get_user(self, nick: bytes) -> Optional[User]:
+        return self.users.get(casefold(nick))
+
+    def members(self, channel_name: bytes) -> Iterator[User]:
+        "Everyone on a channel"
+        channel = self.get_channel(channel_name)
+        if channel is not None:
+            for nick in channel.users:
+                yield self.users[nick]
+
+    def add_channel(self, name: bytes) -> Channel:
+        "Start tracking a channel, unless it's already being tracked"
+        key = casefold(name)
+        channel = self.channels.get(key)
+        if channel is None:
+            channel = self.channels[key] = Channel(name)
+        return channel
+
+    def remove_channel(self, name: bytes) -> None:
+        "Stop tracking a channel, forgetting the users that were only there"
+        channel = self.channels.pop(casefold(name), None)
+        if channel is not None:
+            for nick in list(channel.users):
+                self._leave(nick, channel)
+
+    def join(self, nick: bytes, channel_name: bytes, user: Optional[bytes] = None,
+             host: Optional[bytes] = None, prefixes: bytes = b"") -> Optional[User]:
+        """
+        Record that someone is on a channel, updating whatever else is known about them.
+        Returns `None` if the channel isn't being tracked
+        """
+        channel = self.get_channel(channel_name)
+        if channel is None:
+            return None
+        key = casefold(nick)
+        known = self.users.get(key)
+        if known is None:
+            known = self.users[key] = User(nick)
+        if user is not None:
+            known.user = user
+        if host is not None:
+            known.host = host
+        known.channels.add(casefold(channel.name))
+        channel.users[key] = prefixes
+        return known
+
+    def part(self, nick: bytes, channel_name: bytes) -> None:
+        "Record that someone left a channel, or was kicked from it"
+        channel = self.get_channel(channel_name)
+        if channel is not None:
+            self._leave(casefold(nick), channel)
+
+    def quit(self, nick: bytes) -> None:
+        "Forget someone who left the server"
+        known = self.users.pop(casefold(nick), None)
+        if known is not None:
+            for name in known.channels:
+                del self.channels[name].users[casefold(nick)]
+
+    def rename(self, old: bytes, new: bytes) -> None:
+        "Follow a NICK change"
+        old_key, new_key = casefold(old), casefold(new)
+        known = self.users.pop(old_key, None)
+        if known is None:
+            return
+        known.nick = new
+        self.users[new_key] = known
+        for name in known.channels:
+            users = self.channels[name].users
+            users[new_key] = users.pop(old_key)
+
+    def names(self, channel_name: bytes, names: Iterable[bytes]) -> None:
+        "Record one RPL_NAMREPLY. A list can take several of them, and only replaces the members once it ends"
+        channel = self.get_channel(channel_name)
+        if channel is None:
+            return
+        if channel._names is None:
+            channel._names = {}
+        for name in names:
+            prefixes, nick = split_prefixes(name)
+            if nick:
+                self.join(nick, channel_name, prefixes=prefixes)
+                channel._names[casefold(nick)] = prefixes
+
+    def end_of_names(self, channel_name: bytes) -> None:
+        "Handle RPL_ENDOFNAMES: anyone who wasn't listed isn't on the channel anymore"
+        channel = self.get_channel(channel_name)
+        if channel is None or channel._names is None:
+            return
+        for nick in [nick for nick in channel.users if nick not in channel._names]:
+            self._leave(nick, channel)
+        channel._names = None
+
+    def who(self, channel_name: bytes, nick: bytes, user: bytes, host: bytes, realname: bytes,
+            prefixes: bytes) -> None:
+        "Record one RPL_WHOREPLY"
+        known = self.join(nick, channel_name, user, host, prefixes)
+        if known is not None:
+            known.realname = realname
+
+    def clear(self) -> None:
+        self.channels.clear()
+        self.users.clear()
+
+    def _leave(self, nick: bytes, channel: Channel) -> None:
+        channel.users.pop(nick, None)
+        known = self.users.get(nick)
+        if known is not None:
+            known.channels.discard(casefold(channel.name))
+            if not known.channels:
+                del self.users[nick]
@@ -0,0 +1,228 @@
+import hashlib
+import mmap
+import os
+import struct
+import time
+
+from typing import Callable, List
+
+#One index entry per line: wall clock time it was said, where the line starts in its segment's log, and its length
+RECORD = struct.Struct("<dII")
+
+
+#The history of one channel, kept as a directory of segments that are only ever appended to
+#Each segment is a .log file holding the raw lines back to back and an .idx file of RECORD entries, both named
+#after the hex sequence number of their first line. Queries mmap the index and only copy out the lines they return
+class ChannelLog:
+    def __init__(self, directory: str, segmentSize: int, maxSegments: int) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.maxSegments = maxSegments
+        #first sequence number of every segment, oldest first
+        self.segments = sorted(int(name[:-4], 16) for name in os.listdir(directory) if name.endswith(".idx"))
+        #lines not written out yet, as (timestamp, line)
+        self.pending = []
+        self.pendingBytes = 0
+        self.logFile = None
+        self.indexFile = None
+        #channels and bus deliveries using this log, see History.open
+        self.holders = 0
+        if self.segments:
+            self.open_segment(self.segments[-1])
+        else:
+            self.new_segment(0)
+
+    def path(self, first: int, extension: str) -> str:
+        return os.path.join(self.directory, "%016x%s" % (first, extension))
+
+    #Opens a segment for appending, dropping a partly written last index entry left by a crash
+    def open_segment(self, first: int) -> None:
+        self.logFile = open(self.path(first, ".log"), "ab")
+        self.indexFile = open(self.path(first, ".idx"), "ab")
+        size = self.indexFile.tell()
+        if size % RECORD.size:
+            size -= size % RECORD.size
+            self.indexFile.truncate(size)
+        self.activeFirst = first
+        self.activeCount = size // RECORD.size
+        self.activeSize = self.logFile.tell()
+
+    def new_segment(self, first: int) -> None:
+        self.close_files()
+        if not self.segments or self.segments[-1] != first:
+            self.segments.append(first)
+        self.open_segment(first)
+        while len(self.segments) > self.maxSegments:
+            oldest = self.segments.pop(0)
+            for extension in (".log", ".idx"):
+                try:
+                    os.remove(self.path(oldest, extension))
+                except FileNotFoundError:
+                    pass
+
+    def append(self, timestamp: float, line: bytes) -> None:
+        self.pending.append((timestamp, line))
+        self.pendingBytes += len(line)
+
+    #Writes the pending lines out, the log before the index so an entry never points past the data
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        lines = []
+        entries = []
+        for timestamp, line in self.pending:
+            if self.activeCount and self.activeSize + len(line) > self.segmentSize:
+                self.write(lines, entries)
+                lines, entries = [], []
+                self.new_segment(self.activeFirst + self.activeCount)
+            entries.append(RECORD.pack(timestamp, self.activeSize, len(line)))
+            lines.append(line)
+            self.activeSize += len(line)
+            self.activeCount += 1
+        self.write(lines, entries)
+        self.pending.clear()
+        self.pendingBytes = 0
+
+    def write(self, lines: List[bytes], entries: List[bytes]) -> None:
+        self.logFile.write(b"".join(lines))
+        self.logFile.flush()
+        self.indexFile.write(b"".join(entries))
+        self.indexFile.flush()
+
+    def close_files(self) -> None:
+        if self.logFile is not None:
+            self.logFile.close()
+            self.indexFile.close()
+            self.logFile = self.indexFile = None
+
+    def close(self) -> None:
+        self.flush()
+        self.close_files()
+
+    #The last `count` lines, oldest first
+    def latest(self, count: int) -> List[bytes]:
+        if count <= 0:
+            return []
+        lines = [line for _, line in self.pending[-count:]]
+        for first in reversed(self.segments):
+            if len(lines) >= count:
+                break
+            lines[:0] = self.read(first, lambda index, entries: max(0, entries - (count - len(lines))))
+        return lines
+
+    #Up to `count` lines said after `timestamp`, oldest first
+    def since(self, timestamp: float, count: int) -> List[bytes]:
+        lines = []
+        for first in self.segments:
+            if len(lines) >= count:
+                return lines
+            lines += self.read(first, lambda index, entries: search(index, entries, timestamp), count - len(lines))
+        lines += [line for said, line in self.pending if said > timestamp]
+        return lines[:count]
+
+    #Maps a segment and copies out at most `limit` of its lines, from the entry `start` picks given the mapped index
+    #and the number of entries in it
+    def read(self, first: int, start: Callable[[mmap.mmap, int], int], limit: int = -1) -> List[bytes]:
+        with open(self.path(first, ".idx"), "rb") as indexFile, open(self.path(first, ".log"), "rb") as logFile:
+            indexSize = os.fstat(indexFile.fileno()).st_size
+            logSize = os.fstat(logFile.fileno()).st_size
+            entries = indexSize // RECORD.size
+            if not entries or not logSize:
+                return []
+            with mmap.mmap(indexFile.fileno(), 0, access=mmap.ACCESS_READ) as index, \
+                    mmap.mmap(logFile.fileno(), 0, access=mmap.ACCESS_READ) as log:
+                lines = []
+                begin = start(index, entries)
+                end = entries if limit < 0 else min(entries, begin + limit)
+                for entry in range(begin, end):
+                    _, offset, length = RECORD.unpack_from(index, entry * RECORD.size)
+                    if offset + length <= logSize:
+                        lines.append(log[offset:offset + length])
+                return lines
+
+
+
+#Binary search for the first entry of an index said after `timestamp`
+def search(index: mmap.mmap, entries: int, timestamp: float) -> int:
+    low, high = 0, entries
+    while low < high:
+        middle = (low + high) // 2
+        if RECORD.unpack_from(index, middle * RECORD.size)[0] <= timestamp:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+#Channel names up to this many bytes get a directory named after their hex, longer ones after a hash, so every
+#name the server accepts fits in a file name
+MAX_HEX_NAME = 64
+
+
+#Every channel's history, under one directory with a subdirectory per channel
+#Lines are only buffered when they are said, and written out together once per flush interval, or as soon as a
+#channel has flushBytes waiting, so the event loop doesn't make a write call for every message
+#A channel's log stays open while anything holds it, and until its pending lines are flushed after that
+class History:
+    def __init__(self, directory: str, replay: int = 20, segmentSize: int = 2 ** 22, maxSegments: int = 16,
+                 flushInterval: float = 1.0, flushBytes: int = 2 ** 16) -> None:
+        self.directory = directory
+        #lines sent to a client when it joins a channel
+        self.replay = replay
+        self.segmentSize = segmentSize
+        self.maxSegments = maxSegments
+        self.flushInterval = flushInterval
+        self.flushBytes = flushBytes
+        self.dirty = set()
+        #open logs by directory, so a channel and lines about it from other shards share one
+        self.logs = {}
+
+    #Opens the history of a channel, given its folded name, every open has to be matched by a close
+    def open(self, name: bytes) -> ChannelLog:
+        directory = os.path.join(self.directory, directory_name(name))
+        log = self.logs.get(directory)
+        if log is None:
+            log = ChannelLog(directory, self.segmentSize, self.maxSegments)
+            self.logs[directory] = log
+        log.holders += 1
+        return log
+
+    def close(self, log: ChannelLog) -> None:
+        log.holders -= 1
+        if not log.holders and log not in self.dirty:
+            self.release(log)
+
+    def release(self, log: ChannelLog) -> None:
+        del self.logs[log.directory]
+        log.close()
+
+    #Buffers a line, returns whether a flush has to be scheduled for it
+    def record(self, log: ChannelLog, line: bytes) -> bool:
+        log.append(time.time(), line)
+        if log.pendingBytes >= self.flushBytes:
+            log.flush()
+            return False
+        if self.dirty:
+            self.dirty.add(log)
+            return False
+        self.dirty.add(log)
+        return True
+
+    #Called by the server's scheduler once the flush interval has passed
+    def check_timeout(self, now: float) -> None:
+        self.flush()
+
+    def flush(self) -> None:
+        for log in self.dirty:
+            log.flush()
+            if not log.holders:
+                self.release(log)
+        self.dirty.clear()
+
+
+#"h-" can't start a hex name, so a hashed name never collides with one
+def directory_name(name: bytes) -> str:
+    if len(name) <= MAX_HEX_NAME:
+        return name.hex()
+    return "h-" + hashlib.sha256(name).hexdigest()
@@ -0,0 +1,126 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import time
+
+from typing import List, Tuple
+
+#Histograms count durations in power of two buckets of nanoseconds, the last bucket takes everything longer
+#2 ** 34 ns is about 17 seconds
+BUCKETS = 35
+
+
+#Latency histogram, recording is O(1) and never allocates
+class Histogram:
+    __slots__ = ("buckets", "count", "total")
+
+    def __init__(self) -> None:
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        #nanoseconds
+        self.total = 0
+
+    def observe(self, nanoseconds: int) -> None:
+        self.buckets[min(nanoseconds.bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += nanoseconds
+
+
+#Everything the server counts about itself
+#Counters and histograms are updated on the hot paths, gauges are only worked out when the metrics are read
+class Metrics:
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.accepted = 0
+        self.rejected = 0
+        self.linesReceived = 0
+        self.bytesReceived = 0
+        self.bytesSent = 0
+        self.unknownCommands = 0
+        self.sendqExceeded = 0
+        self.throttledLines = 0
+        self.excessFlood = 0
+        self.accept = Histogram()
+        self.parse = Histogram()
+        self.dispatch = Histogram()
+        self.fanout = Histogram()
+        self.send = Histogram()
+
+    def counters(self) -> List[Tuple[str, str, int]]:
+        return [
+            ("accepted_connections", "connections accepted", self.accepted),
+            ("rejected_connections", "connections closed for coming from an address with too many", self.rejected),
+            ("lines_received", "lines received from clients", self.linesReceived),
+            ("bytes_received", "bytes received from clients", self.bytesReceived),
+            ("bytes_sent", "bytes sent to clients", self.bytesSent),
+            ("unknown_commands", "lines with a command the server doesn't know", self.unknownCommands),
+            ("sendq_exceeded", "clients dropped for letting too much output queue up", self.sendqExceeded),
+            ("throttled_lines", "lines queued for sending faster than the flood rate", self.throttledLines),
+            ("excess_flood", "clients dropped for queueing up too many lines", self.excessFlood),
+        ]
+
+    def histograms(self) -> List[Tuple[str, str, Histogram]]:
+        return [
+            ("accept_seconds", "time taken to accept a connection", self.accept),
+            ("parse_seconds", "time taken to parse a line", self.parse),
+            ("dispatch_seconds", "time taken to handle a command, including any fan-out", self.dispatch),
+            ("fanout_seconds", "time taken to queue a line for every member of a channel", self.fanout),
+            ("send_seconds", "time taken by a single sendmsg call", self.send),
+        ]
+
+    #Prometheus text exposition format
+    def render(self, server) -> bytes:
+        queued = [client.writeQueued for client in server.clients]
+        gauges = [
+            ("connections", "clients connected", len(server.clients)),
+            ("channels", "channels with at least one member", len(server.channels)),
+            ("sendq_bytes", "bytes queued for all clients", sum(queued)),
+            ("sendq_bytes_max", "most bytes queued for a single client", max(queued, default=0)),
+            ("uptime_seconds", "seconds since the server started", time.time() - self.started),
+        ]
+        lines = []
+        for name, help, value in self.counters():
+            lines += [f"# HELP ircd_{name}_total {help}", f"# TYPE ircd_{name}_total counter",
+                      f"ircd_{name}_total {value}"]
+        for name, help, value in gauges:
+            lines += [f"# HELP ircd_{name} {help}", f"# TYPE ircd_{name} gauge", f"ircd_{name} {value}"]
+        for name, help, histogram in self.histograms():
+            lines += [f"# HELP ircd_{name} {help}", f"# TYPE ircd_{name} histogram"]
+            seen = 0
+            for bucket, count in enumerate(histogram.buckets[:-1]):
+                seen += count
+                lines.append(f'ircd_{name}_bucket{{le="{2 ** bucket / 1e9:g}"}} {seen}')
+            lines += [f'ircd_{name}_bucket{{le="+Inf"}} {histogram.count}',
+                      f"ircd_{name}_sum {histogram.total / 1e9:g}", f"ircd_{name}_count {histogram.count}"]
+        return ("\n".join(lines) + "\n").encode()
+
+
+#the thread writing log records, see start_logging
+listener = None
+
+
+#Sends log records through a queue to a thread that does the actual writing, so logging never blocks the loop
+#Must be called in the process that logs, after any fork, as the writing thread doesn't survive a fork
+#The thread is stopped at exit, writing out whatever is still queued, see stop_logging
+def start_logging(level: str) -> logging.handlers.QueueListener:
+    global listener
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(process)d %(message)s"))
+    listener = logging.handlers.QueueListener(records, handler)
+    root = logging.getLogger()
+    root.setLevel(level.upper())
+    root.addHandler(logging.handlers.QueueHandler(records))
+    listener.start()
+    atexit.register(stop_logging)
+    return listener
+
+
+#Writes out every queued record and stops the writing thread
+#Called at exit, and directly by processes that leave through os._exit, which skips atexit
+def stop_logging() -> None:
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
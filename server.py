@@ -1,283 +1,1380 @@
-import socket
-import time
-import sys
-import threading
-import string
-
-from typing import Any, Collection, Dict, List, Optional, Sequence, Set
-
-Socket = socket.socket
-
-class Channel:
-    def __init__(self, server: "Server", name: bytes) -> None:
-        self.server = server
-        self.name = name
-        self.members = []
-
-    def add_member(self, client: "Client") -> None:
-        self.members.append(client)
-
-    def sendMsg(self, args: [bytes], client: "Client") -> None:
-        for members in self.members:
-            if members != client:
-                members.writeBuffer += b":%s!%s@%s PRIVMSG #%s %s \n\r" % (members.nickname, members.user, members.host, args[0], args[1])
-
-
-class Client:
-    def __init__(self, server: "Server", socket: Socket) -> None:
-        self.server = server
-        self.socket = socket
-        self.user = b""
-        self.nickname = b""
-        self.realname = b""
-        self.channels = []
-        self.lastPing = time.time()
-        self.readBuffer = b""
-        self.writeBuffer = b""
-
-        host, port, _, _ = socket.getpeername()
-        self.host = host.encode()
-        self.port = port
-
-
-    #Pings client, if client doesnt respond, diconnected and removed
-    def ping(self, now) -> None:
-        if self.lastPing + 300 == now:
-            print("Disconnecting \n\r")
-            self.disconnect(self)
-        else:
-            data = b"PING :%s" % self.host
-            try:
-                sent = self.socket.send(data)
-                if sent:
-                    self.lastPing = time.time()
-                else:
-                    self.disconnect()
-            except Exception as e:
-                print(f"Error: {e}")
-                print(f"Disconnecting\n\r")
-                self.disconnect()
-
-    #Removed client object from server
-    def disconnect(self) -> None:
-        try:
-            self.socket.close()
-            self.server.remove_client(self)
-        except socket.error as e:
-            print(f"Socket Error: {e}")
-
-    #checks for new information from server
-    def check_msg(self) -> None:
-        try:
-            self.socket.settimeout(0.5)
-            data = self.socket.recv(1024)
-            if data:
-                ##send data through parser to check for commands or other..
-                self.readBuffer += data
-                self.parse()
-        except socket.error as e:
-            data = b""
-
-    #parses and splits lines of data to be handled correctly
-    def parse(self) -> None:
-        lines = self.readBuffer.splitlines()
-        self.readBuffer = b""
-        for line in lines:
-            if not line:
-                continue
-            x = line.split(b" ")
-            command = x[0].upper()
-            args = []
-            for y in range(1, len(x)):
-                args.append(x[y]) 
-            self.handler(command, args)
-
-    #Command handlers
-    def handler(self, command: bytes, args: [bytes]) -> None:
-        if command == b"NICK" and len(args) > 0:
-            oldnickname = self.nickname
-            self.nickname = args[0]
-            self.setNickname(oldnickname)
-            print(f"{self.writeBuffer}")
-        if command == b"USER" and len(args) > 0:
-            self.user = b"Guest"
-            self.realname = args[0]
-        if command == b"QUIT":
-            msg = args[0]
-            self.writeBuffer += b":%s!%s@%s QUIT %s \n\r" % (self.nickname, self.user, self.host, args[0])
-            self.send_msg()    
-        if command == b"JOIN" and len(args) > 0:
-            if not self.server.channels:
-                self.writeBuffer += b":%s!%s@%s JOIN %s \n\r" % (self.nickname, self.user, self.host, args[0])
-                channel = Channel(self.server, args[0])
-                self.server.add_channel(channel)
-                self.channels.append(channel)
-                channel.add_member(self)
-            else:
-                for channel in self.server.channels:
-                    if channel.name == args[0]:
-                        for client in self.server.clients:
-                            self.writeBuffer += b":%s!%s@%s JOIN %s \n\r" % (client.nickname, client.user, client.host, args[0])
-                        channel.add_member(self)
-                        self.channels.append(channel)                 
-        if command == b"PRIVMSG" and len(args) > 0:
-            for channel in self.channels:
-                if channel.name == args[0]:
-                    channel.sendMsg(args, self)
-            for client in self.server.clients:
-                if client.nickname == args[0] and client.nickname != self.nickname:
-                    self.writeBuffer += b":%s!%s@%s PRIVMSG %s %s \n\r" % (self.nickname, self.user, self.host, args[0], args[1])
-        if command == b"PART" and len(args) > 0:
-            try:
-                for x in range(0, len(self.channels)):
-                    if self.channels[x] == args[0]:
-                        self.channels[x].members.remove(self)
-                self.channels.remove(args[0])
-                self.server.channels.remove(args[0])
-            except Exception as e:
-                print(f"{e}")
-            self.writeBuffer += b":%s!%s@%s PART %s %s\n\r" % (self.nickname, self.user, self.host, args[0], args[1])
-            
-    #Sets client nickname       
-    def setNickname(self, oldnick: bytes) -> None:
-        self.writeBuffer += b":%s!%s@%s NICK %s\n\r" % (oldnick, self.user, self.host, self.nickname)
-
-    #Sends info to server
-    def send_msg(self) -> None:
-        if self.writeBuffer:
-            print(f"{self.writeBuffer}")
-            try:
-                sent = self.socket.send(self.writeBuffer)
-            except socket.error as x:
-                print(f"Socket Error:{x}")
-            self.writeBuffer = b""
-
-class Server:
-    def __init__(self) -> None:
-        self.host = b"fc00:1337::17"
-        self.port = 6667
-        self.clients = []
-        self.channels = []
-
-    #Used to create and bind the socket, then to sets to run
-    def start(self) -> None:
-        s = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-        try:
-            s.bind((b'fc00:1337::17', 6667,))
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,1)
-            s.settimeout(5)
-        except socket.error as e:
-            print(f"Could not bind Port: {e}")
-            sys.exit(1)
-        s.listen(10)
-        print(f"Listening on port 6667")
-        try:
-            pass
-            self.run(s)
-        except Exception as e:
-            print(f"Error: {e}")
-            sys.exit(1)
-
-    #Creates threads for each main process
-    #allows for the server run indefinitely
-    def run(self, s: socket) -> None:
-        last_ping = time.time()
-
-        threads = []
-
-        try:
-            create = threading.Thread(target=self.add_client, args=[s])
-            create.start()
-            threads.append(create)
-        except Exception as e:
-            print(f"{e}")
-
-        ping = threading.Thread(target=self.ping_clients)
-        ping.start()
-        threads.append(ping)
-
-        try:
-            send = threading.Thread(target=self.send_messages)
-            send.start()
-            threads.append(send)  
-        except Exception as e:
-            print(f"{e}")
-
-        try:
-            receive = threading.Thread(target=self.check_messages)
-            receive.start()
-            threads.append(receive)    
-        except Exception as e:
-            print(f"{e}")
-
-
-
-
-    #Waits for a connection and tries to add the client to the server    
-    def add_client(self, s: socket) -> None:
-        while True:
-            try:
-                conn, addr = s.accept()
-                self.clients.append(Client(self, conn))
-                print(f"Accepted connection from {addr[0]}:{addr[1]}. \n\r")
-                conn = b""
-                addr = b""
-            except Exception as e:
-                try:
-                    conn.close()
-                except:
-                    pass
-                
-    #Pings all clients within the server, will diconnect if they timeout       
-    def ping_clients(self) -> None:
-        last_ping = time.time()
-        while True:
-            now = time.time()
-            if last_ping + 5 < now:
-                for client in self.clients:
-                    client.ping(now)
-                last_ping = now
-
-    #Remove client details from server
-    def remove_client(self, client: "Client") -> None:
-        try:
-            self.clients.remove(client)
-        except Exception:
-            print(f"Client: {client} removed")
-
-    #constantly checks for new data/msgs
-    def check_messages(self) -> None:
-        while True:
-            for clients in self.clients:
-                try:
-                    clients.check_msg()
-                except:
-                    pass
-
-    #constantly streams data to the server
-    def send_messages(self) -> None:
-        while True:
-            for clients in self.clients:
-                try:
-                    clients.send_msg()
-                except:
-                    pass
-                
-    #gets client object
-    def get_client(self, clientName):
-        for x in self.clients:
-            if x.nickname == clientName :
-                return x.nickname
-
-    #adds channel to server
-    def add_channel(self, channel: "Channel") -> None:
-        self.channels.append(channel)
-    
-        
-def main() -> None:
-    server = Server()
-    server.start()
-
-
-if __name__ == "__main__":
-    main()
+import argparse
+import datetime
+import heapq
+import itertools
+import logging
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+import sys
+import string
+import struct
+
+from collections import deque
+
+from typing import Any, Callable, Collection, Dict, List, Optional, Sequence, Set, Tuple
+
+import snapshot
+from bot import command
+from history import ChannelLog, History
+from metrics import Metrics, start_logging, stop_logging
+
+Socket = socket.socket
+
+log = logging.getLogger("server")
+
+#Most chunks handed to a single sendmsg call
+MAX_IOV = 64
+#Size of the shared buffer every client reads into
+READ_SIZE = 2 ** 14
+#Longest line a client may send, including the CRLF
+MAX_LINE = 512
+#Every this many bytes of a line cost as much flood allowance as another line
+FLOOD_LINE_BYTES = 128
+#Most lines a single CHATHISTORY request gets
+MAX_HISTORY = 1000
+#Environment variables a restarted server finds the file descriptors of its listening sockets and its metrics
+#socket in, the path of the snapshot of the clients and channels it takes over, and the socket it reports having
+#taken them over on
+LISTEN_FDS = "IRCD_LISTEN_FDS"
+METRICS_FD = "IRCD_METRICS_FD"
+SNAPSHOT = "IRCD_SNAPSHOT"
+READY_FD = "IRCD_READY_FD"
+#Seconds a server being replaced waits for the new one to take over before it gives up and carries on itself
+RESTART_TIMEOUT = 30
+#Length of each message packed into a bus datagram
+BUS_HEADER = struct.Struct("!H")
+#Bytes of datagrams a shard may have waiting for a peer that isn't reading, before it drops new ones
+MAX_BUS_BACKLOG = 2 ** 22
+
+#Channel names start with one of these, anything else is a nickname
+CHANNEL_PREFIXES = b"#&"
+#Characters rfc2812 doesn't allow in a channel name, on top of space and the line terminators
+CHANNEL_FORBIDDEN = b",\x07"
+
+#What rfc2812 allows in a nickname, which can't start with a digit or -
+NICK_START = set((string.ascii_letters + "[]\\`_^{|}").encode())
+NICK_CHARACTERS = NICK_START | set((string.digits + "-").encode())
+
+#rfc1459 casemapping, {}|^ are the lowercase forms of []\~
+CASEMAP = bytes.maketrans(string.ascii_uppercase.encode() + b"[]\\~", string.ascii_lowercase.encode() + b"{}|^")
+
+def is_channel(name: bytes) -> bool:
+    return bool(name) and name[0] in CHANNEL_PREFIXES
+
+#Builds ":<source> <middle> :<text>", cutting the text short so the line fits in MAX_LINE, as the line the text
+#came from did without the source in front of it
+def relayed(source: bytes, middle: bytes, text: bytes) -> bytes:
+    line = b":%s %s :" % (source, middle)
+    return line + text[:MAX_LINE - 2 - len(line)] + b"\r\n"
+
+#Folds a nickname or channel name so lookups are case insensitive
+def irc_lower(name: bytes) -> bytes:
+    return name.translate(CASEMAP)
+
+class Channel:
+    __slots__ = ("server", "name", "members", "log")
+
+    def __init__(self, server: "Server", name: bytes) -> None:
+        self.server = server
+        self.name = name
+        #insertion ordered, so members are messaged in the order they joined
+        self.members = {}
+        #history of the channel, only kept if the server has history enabled
+        self.log = None
+
+    def add_member(self, client: "Client") -> None:
+        self.members[client] = None
+
+    def remove(self, client: "Client") -> None:
+        self.members.pop(client, None)
+
+    #Queues an already serialized line for every member, the same bytes object is shared by all of them
+    def deliver(self, line: bytes, exclude: Optional["Client"] = None) -> None:
+        start = time.perf_counter_ns()
+        for member in self.members:
+            if member is not exclude:
+                member.write(line)
+        self.server.metrics.fanout.observe(time.perf_counter_ns() - start)
+
+    #Delivers a line to the members on this server and to every other shard, if running sharded
+    def broadcast(self, line: bytes, exclude: Optional["Client"] = None) -> None:
+        self.deliver(line, exclude)
+        if self.server.bus is not None:
+            self.server.bus.publish_channel(self.name, line)
+
+    #Like broadcast, but the line is also kept in the channel's history, on every shard
+    def sendMsg(self, args: [bytes], client: "Client") -> None:
+        line = relayed(client.prefix(), b"PRIVMSG " + self.name, args[1])
+        self.deliver(line, client)
+        self.record(line)
+        if self.server.bus is not None:
+            self.server.bus.publish_message(self.name, line)
+
+    def record(self, line: bytes) -> None:
+        if self.log is not None:
+            self.server.record(self.log, line)
+
+
+class Client:
+    #there is one of these per connection, so they don't get a __dict__
+    __slots__ = ("server", "socket", "connected", "user", "nickname", "realname", "channels",
+                 "lastActivity", "pingSent", "readBuffer", "discarding", "writeQueue", "writeQueued", "closing",
+                 "floodTime", "recvQueue", "recvQueued", "host", "port")
+
+    #address is the peer address accept returned, it's looked up if not given
+    def __init__(self, server: "Server", socket: Socket, address: Optional[Tuple] = None) -> None:
+        self.server = server
+        self.socket = socket
+        self.connected = True
+        self.user = b""
+        self.nickname = b""
+        self.realname = b""
+        self.channels = set()
+        #monotonic time of the last data received, and of the PING still waiting for an answer if any
+        self.lastActivity = time.monotonic()
+        self.pingSent = None
+        #unterminated tail of the last read, never longer than MAX_LINE
+        self.readBuffer = b""
+        self.discarding = False
+        #outbound chunks, the head may be a memoryview of a partially sent chunk
+        #only allocated while there is something to send, as an empty deque alone is over 600 bytes
+        self.writeQueue = None
+        self.writeQueued = 0
+        self.closing = False
+        #the time the client's lines so far would have taken at the server's flood rate, see take_input
+        self.floodTime = 0.0
+        #lines received faster than the flood rate allows, waiting to be processed, allocated like writeQueue
+        self.recvQueue = None
+        self.recvQueued = 0
+
+        host, port = (address or socket.getpeername())[:2]
+        self.host = host.encode()
+        self.port = port
+
+
+    #Called by the server's scheduler once this client's deadline has passed
+    #Pings the client once it has been idle too long, and diconnects it if the ping goes unanswered
+    def check_timeout(self, now: float) -> None:
+        if not self.connected or self.closing:
+            return
+        if self.pingSent is None:
+            idle_deadline = self.lastActivity + self.server.ping_interval
+            if now < idle_deadline:
+                self.server.schedule(self, idle_deadline)
+                return
+            self.write(b"PING :%s\r\n" % self.server.host)
+            self.pingSent = now
+            self.server.schedule(self, now + self.server.ping_timeout)
+        elif self.lastActivity > self.pingSent:
+            # Anything received since the ping proves the client is still there
+            self.pingSent = None
+            self.server.schedule(self, self.lastActivity + self.server.ping_interval)
+        elif now >= self.pingSent + self.server.ping_timeout:
+            self.close_link(b"Ping timeout: %d seconds" % self.server.ping_timeout)
+        else:
+            self.server.schedule(self, self.pingSent + self.server.ping_timeout)
+
+    #Removed client object from server
+    def disconnect(self) -> None:
+        if not self.connected:
+            return
+        self.connected = False
+        for channel in list(self.channels):
+            self.leave(channel)
+        self.server.remove_client(self)
+        try:
+            self.socket.close()
+        except socket.error as e:
+            log.warning("Socket error closing %s: %s", self.host.decode(), e)
+
+    #checks for new information from server, only called once the socket is readable
+    def check_msg(self) -> None:
+        try:
+            received = self.socket.recv_into(self.server.readBuffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error as e:
+            log.debug("Socket error reading from %s: %s", self.host.decode(), e)
+            self.disconnect()
+            return
+        if not received:
+            self.disconnect()
+            return
+        self.lastActivity = time.monotonic()
+        self.server.metrics.bytesReceived += received
+        ##send data through parser to check for commands or other..
+        self.frame(self.server.readView, received)
+
+    #Splits received data into lines, keeping an unterminated tail around for the next read
+    #Lines longer than MAX_LINE are dropped whole rather than being parsed as several commands
+    def frame(self, data: memoryview, length: int) -> None:
+        buffer = self.server.readBuffer
+        start = 0
+        while self.connected:
+            end = buffer.find(b"\n", start, length)
+            if end < 0:
+                break
+            if self.readBuffer:
+                line = self.readBuffer + data[start:end]
+                self.readBuffer = b""
+            else:
+                line = data[start:end].tobytes()
+            start = end + 1
+            if self.discarding:
+                self.discarding = False
+                continue
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            if len(line) > MAX_LINE - 2:
+                self.line_too_long()
+            elif line:
+                self.receive_line(line)
+        if start < length and self.connected and not self.discarding:
+            #a tail ending in \r may be a full length line whose \n is still on its way
+            tail = len(self.readBuffer) + length - start
+            if tail > MAX_LINE - 2 and not (tail == MAX_LINE - 1 and buffer[length - 1] == 13):
+                self.readBuffer = b""
+                self.discarding = True
+                self.line_too_long()
+            else:
+                self.readBuffer += data[start:length]
+
+    #Processes a line right away if the client is within its flood allowance, otherwise queues it until it is
+    #A client whose queue grows past the server's max_recvq is disconnected for flooding
+    def receive_line(self, line: bytes) -> None:
+        if self.closing:
+            return
+        if not self.recvQueue and self.take_input(len(line), self.lastActivity):
+            self.parse(line)
+            return
+        if self.recvQueued + len(line) > self.server.max_recvq:
+            self.closing = True
+            self.server.metrics.excessFlood += 1
+            self.server.schedule_disconnect(self, b"Excess Flood")
+            return
+        if self.recvQueue is None:
+            self.recvQueue = deque()
+        if not self.recvQueue:
+            self.server.schedule_input(self, self.floodTime - self.server.flood_window)
+        self.recvQueue.append(line)
+        self.recvQueued += len(line)
+        self.server.metrics.throttledLines += 1
+
+    #Token bucket kept as a single timestamp, as classic ircds do: every line pushes floodTime forward by its cost,
+    #and a line may only be processed while floodTime is less than the server's flood_window ahead of now
+    def take_input(self, length: int, now: float) -> bool:
+        server = self.server
+        if not server.flood_rate:
+            return True
+        start = self.floodTime if self.floodTime > now else now
+        if start - now > server.flood_window:
+            return False
+        self.floodTime = start + (1 + length // FLOOD_LINE_BYTES) / server.flood_rate
+        return True
+
+    #Called by the server once the client may send another line, processes as many queued lines as it may
+    def process_queued(self, now: float) -> None:
+        while self.recvQueue and self.connected and not self.closing:
+            line = self.recvQueue[0]
+            if not self.take_input(len(line), now):
+                self.server.schedule_input(self, self.floodTime - self.server.flood_window)
+                return
+            self.recvQueue.popleft()
+            self.recvQueued -= len(line)
+            self.parse(line)
+        self.recvQueue = None
+        self.recvQueued = 0
+
+    def line_too_long(self) -> None:
+        self.numeric(b"417", b":Input line was too long")
+
+    #parses a line of data and hands it to the handler registered for its command
+    def parse(self, line: bytes) -> None:
+        metrics = self.server.metrics
+        metrics.linesReceived += 1
+        start = time.perf_counter_ns()
+        try:
+            message = command.Command(line)
+        except command.Error:
+            return
+        parsed = time.perf_counter_ns()
+        metrics.parse.observe(parsed - start)
+        self.handler(message.command.upper(), message.args)
+        metrics.dispatch.observe(time.perf_counter_ns() - parsed)
+
+    #Looks the command up in the server's command table
+    def handler(self, name: bytes, args: Sequence[bytes]) -> None:
+        try:
+            handler, min_args = self.server.commands[name]
+        except KeyError:
+            self.server.metrics.unknownCommands += 1
+            self.numeric(b"421", b"%s :Unknown command" % name)
+            return
+        if len(args) < min_args:
+            self.numeric(b"461", b"%s :Not enough parameters" % name)
+            return
+        handler(self, args)
+
+    #Sends a numeric reply from the server to this client
+    def numeric(self, code: bytes, text: bytes) -> None:
+        self.write(b":%s %s %s %s\r\n" % (self.server.host, code, self.nickname or b"*", text))
+
+    def nick_command(self, args: Sequence[bytes]) -> None:
+        if not args[0]:
+            self.numeric(b"431", b":No nickname given")
+            return
+        if args[0][0] not in NICK_START or not NICK_CHARACTERS.issuperset(args[0]):
+            self.numeric(b"432", b"%s :Erroneous nickname" % args[0])
+            return
+        if self.server.nick_in_use(args[0], self):
+            self.numeric(b"433", b"%s :Nickname is already in use" % args[0])
+            return
+        oldnickname = self.nickname
+        self.server.rename_client(self, args[0])
+        self.setNickname(oldnickname)
+
+    def user_command(self, args: Sequence[bytes]) -> None:
+        self.user = args[0]
+        self.realname = args[3]
+
+    def ping_command(self, args: Sequence[bytes]) -> None:
+        self.write(relayed(self.server.host, b"PONG " + self.server.host, args[0]))
+
+    def pong_command(self, args: Sequence[bytes]) -> None:
+        self.pingSent = None
+
+    def quit_command(self, args: Sequence[bytes]) -> None:
+        msg = args[0] if args else b""
+        self.write(relayed(self.prefix(), b"QUIT", msg))
+        self.send_msg()
+        self.disconnect()
+
+    def join_command(self, args: Sequence[bytes]) -> None:
+        if not is_channel(args[0]):
+            self.numeric(b"403", b"%s :No such channel" % args[0])
+            return
+        if len(args[0]) < 2 or any(c in CHANNEL_FORBIDDEN for c in args[0]):
+            self.numeric(b"479", b"%s :Illegal channel name" % args[0])
+            return
+        channel = self.server.get_channel(args[0])
+        if channel is None:
+            channel = Channel(self.server, args[0])
+            self.server.add_channel(channel)
+        if channel not in self.channels:
+            channel.add_member(self)
+            self.channels.add(channel)
+            channel.broadcast(b":%s JOIN %s\r\n" % (self.prefix(), channel.name))
+            if channel.log is not None:
+                for line in channel.log.latest(self.server.history.replay):
+                    self.write(line)
+
+    def privmsg_command(self, args: Sequence[bytes]) -> None:
+        target, text = args[0], args[1]
+        if is_channel(target):
+            channel = self.server.get_channel(target)
+            if channel is None:
+                self.numeric(b"403", b"%s :No such channel" % target)
+            elif channel not in self.channels:
+                self.numeric(b"404", b"%s :Cannot send to channel" % target)
+            else:
+                channel.sendMsg(args, self)
+            return
+        line = relayed(self.prefix(), b"PRIVMSG " + target, text)
+        client = self.server.get_client(target)
+        if client is not None:
+            client.write(line)
+        elif self.server.bus is None or not self.server.bus.send_user(target, line):
+            self.numeric(b"401", b"%s :No such nick/channel" % target)
+
+    def part_command(self, args: Sequence[bytes]) -> None:
+        channel = self.server.get_channel(args[0])
+        if channel is not None and channel in self.channels:
+            if len(args) > 1:
+                channel.broadcast(relayed(self.prefix(), b"PART " + channel.name, args[1]))
+            else:
+                channel.broadcast(b":%s PART %s\r\n" % (self.prefix(), channel.name))
+            self.leave(channel)
+
+    #CHATHISTORY LATEST <channel> * <limit> and CHATHISTORY AFTER <channel> timestamp=<time> <limit>, as in IRCv3
+    #Only registered when the server keeps history. There is no capability negotiation, so the lines are sent as is
+    def chathistory_command(self, args: Sequence[bytes]) -> None:
+        subcommand, target, position, limit = args[0].upper(), args[1], args[2], args[3]
+        channel = self.server.get_channel(target)
+        if channel is None or channel not in self.channels:
+            self.numeric(b"442", b"%s :You're not on that channel" % target)
+            return
+        try:
+            limit = min(int(limit), MAX_HISTORY)
+            if subcommand == b"LATEST" and position == b"*":
+                lines = channel.log.latest(limit) if channel.log is not None else []
+            elif subcommand == b"AFTER" and position.startswith(b"timestamp="):
+                since = position[len(b"timestamp="):].decode().replace("Z", "+00:00")
+                since = datetime.datetime.fromisoformat(since).timestamp()
+                lines = channel.log.since(since, limit) if channel.log is not None else []
+            else:
+                raise ValueError
+        except ValueError:
+            self.write(b":%s FAIL CHATHISTORY INVALID_PARAMS %s :Invalid parameters\r\n"
+                       % (self.server.host, subcommand))
+            return
+        for line in lines:
+            self.write(line)
+
+    #Removes the client from a channel, dropping the channel once nobody is left on it
+    def leave(self, channel: "Channel") -> None:
+        self.channels.discard(channel)
+        channel.remove(self)
+        if not channel.members:
+            self.server.remove_channel(channel)
+
+    #nick!user@host, as used to prefix messages from this client
+    def prefix(self) -> bytes:
+        return b"%s!%s@%s" % (self.nickname, self.user, self.host)
+
+    #Sets client nickname, a client's first NICK has no old nickname so it is announced from the new one
+    def setNickname(self, oldnick: bytes) -> None:
+        self.write(b":%s!%s@%s NICK %s\r\n" % (oldnick or self.nickname, self.user, self.host, self.nickname))
+
+    #Queues data for the client, asking the selector to report when the socket is writable
+    #Chunks are queued as is, so a line shared by a channel fan-out is never copied
+    def write(self, data: bytes) -> None:
+        if not self.connected or self.closing:
+            return
+        if self.writeQueued + len(data) > self.server.max_sendq:
+            self.closing = True
+            self.server.metrics.sendqExceeded += 1
+            self.server.schedule_disconnect(self, b"SendQ exceeded")
+            return
+        if not self.writeQueue:
+            self.server.want_write(self, True)
+            if self.writeQueue is None:
+                self.writeQueue = deque()
+        self.writeQueue.append(data)
+        self.writeQueued += len(data)
+
+    #Sends info to server, only called once the socket is writable
+    #Writes as many queued chunks as possible in one sendmsg call and keeps whatever the kernel did not accept
+    def send_msg(self) -> None:
+        if self.writeQueue:
+            chunks = list(itertools.islice(self.writeQueue, MAX_IOV))
+            start = time.perf_counter_ns()
+            try:
+                sent = self.socket.sendmsg(chunks)
+            except (BlockingIOError, InterruptedError):
+                return
+            except socket.error as x:
+                log.debug("Socket error writing to %s: %s", self.host.decode(), x)
+                self.disconnect()
+                return
+            metrics = self.server.metrics
+            metrics.send.observe(time.perf_counter_ns() - start)
+            metrics.bytesSent += sent
+            self.writeQueued -= sent
+            while sent:
+                head = self.writeQueue[0]
+                if sent >= len(head):
+                    sent -= len(head)
+                    self.writeQueue.popleft()
+                else:
+                    self.writeQueue[0] = memoryview(head)[sent:]
+                    sent = 0
+        if not self.writeQueue:
+            self.writeQueue = None
+            self.server.want_write(self, False)
+
+    #Makes a last attempt at telling the client why it is being dropped, then disconnects it
+    def close_link(self, reason: bytes) -> None:
+        try:
+            self.socket.send(b"ERROR :Closing Link: %s (%s)\r\n" % (self.host, reason))
+        except socket.error:
+            pass
+        self.disconnect()
+
+#Token bucket limiting how fast connections are accepted, shared by all of a server's listening sockets
+#While it's empty the listening sockets are taken out of the selector, so new connections wait in the kernel's
+#backlog instead of waking the loop up, and it's scheduled to put them back once there's a token again
+class AcceptThrottle:
+    __slots__ = ("server", "rate", "burst", "tokens", "updated", "paused")
+
+    def __init__(self, server: "Server", rate: float, burst: int) -> None:
+        self.server = server
+        #connections a second, 0 for no limit
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused = False
+
+    #Uses up a token for a connection that was just accepted, returns whether another one may be accepted now
+    #If not, accepting is paused until there is a token again
+    def take(self, now: float) -> bool:
+        if not self.rate:
+            return True
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - 1
+        self.updated = now
+        if self.tokens >= 1:
+            return True
+        if self.paused:
+            return False
+        self.paused = True
+        for listener in self.server.listeners:
+            self.server.selector.unregister(listener)
+        self.server.schedule(self, now + (1 - self.tokens) / self.rate)
+        return False
+
+    #Called by the server's scheduler once there is a token again
+    def check_timeout(self, now: float) -> None:
+        if self.paused:
+            self.paused = False
+            for listener in self.server.listeners:
+                self.server.selector.register(listener, selectors.EVENT_READ, None)
+
+
+#A command handler is called with the client that sent the command and the command's arguments
+Handler = Callable[["Client", Sequence[bytes]], None]
+
+#command -> (handler, minimum number of arguments)
+COMMANDS: Dict[bytes, Tuple[Handler, int]] = {
+    b"NICK": (Client.nick_command, 1),
+    b"USER": (Client.user_command, 4),
+    b"PING": (Client.ping_command, 1),
+    b"PONG": (Client.pong_command, 0),
+    b"QUIT": (Client.quit_command, 0),
+    b"JOIN": (Client.join_command, 1),
+    b"PRIVMSG": (Client.privmsg_command, 2),
+    b"PART": (Client.part_command, 1),
+}
+
+
+class Server:
+    def __init__(self) -> None:
+        #the server's name, as used in the prefix of its messages
+        self.host = b"fc00:1337::17"
+        #(host, port) to listen on, "::" listens on every IPv6 and IPv4 address
+        self.addresses = [("fc00:1337::17", 6667)]
+        self.clients = set()
+        self.nicknames = {}
+        self.channels = {}
+        self.selector = selectors.DefaultSelector()
+        #seconds of silence before a client is pinged, and seconds it then has to answer
+        self.ping_interval = 120
+        self.ping_timeout = 60
+        #heap of (deadline, sequence, client), each client has exactly one entry in it
+        #anything else with a check_timeout(now) method can be scheduled too, like the history's flushes
+        self.timers = []
+        self.timerSequence = itertools.count()
+        #heap of (time, sequence, client) for clients with queued input, each has at most one entry in it
+        self.inputTimers = []
+        #bytes a client may have queued before it is disconnected as too slow
+        self.max_sendq = 2 ** 20
+        self.disconnects = []
+        #the loop only ever services one client at a time, so every read can share this buffer
+        self.readBuffer = bytearray(READ_SIZE)
+        self.readView = memoryview(self.readBuffer)
+        #set when this server is one shard of a sharded server, see serve_sharded
+        self.bus = None
+        self.reuse_port = False
+        self.commands = dict(COMMANDS)
+        #channel history, see enable_history
+        self.history = None
+        self.metrics = Metrics()
+        #unix socket the metrics are served on, see listen_metrics
+        self.metricsSocket = None
+        #listen backlog, and the most connections accepted for a single readiness event
+        self.backlog = 1024
+        self.accept_batch = 256
+        #most connections from a single address, 0 for no limit
+        self.max_per_ip = 0
+        #lines a second a client may send once its burst is used up, 0 for no limit, see Client.take_input
+        self.flood_rate = 2.0
+        self.flood_window = 5.0
+        #bytes of lines a client may have waiting before it is disconnected for flooding
+        self.max_recvq = 8192
+        #address -> connections from it
+        self.connectionsByHost = {}
+        self.throttle = AcceptThrottle(self, 0, 1)
+        self.listeners = []
+        #set once a restart has been asked for, and once a restarted server has taken over, see restart
+        self.restarting = False
+        self.draining = False
+        #set once SIGTERM or SIGINT has been received, the loop then stops after the current iteration
+        self.stopping = False
+        #both ends of the signal wakeup socket, see handle_signals
+        self.signals = None
+        self.wakeup = None
+
+    #Listens on every address, or on the sockets handed over by the server this one is replacing, then runs
+    def start(self) -> None:
+        try:
+            sockets = inherited_listeners() or [self.listen(host, port) for host, port in self.addresses]
+        except socket.error as e:
+            log.critical("Could not bind Port: %s", e)
+            sys.exit(1)
+        for s in sockets:
+            host, port = s.getsockname()[:2]
+            log.info("Listening on %s port %d", host, port)
+        path = os.environ.pop(SNAPSHOT, None)
+        if path is not None:
+            #the server being replaced still has everything and keeps serving if this one exits without reporting
+            try:
+                self.restore(path)
+            except (OSError, snapshot.Error) as e:
+                log.critical("Could not take over from the previous server: %s", e)
+                sys.exit(1)
+            report_ready()
+        try:
+            self.run(*sockets)
+        except Exception as e:
+            log.critical("Error: %s", e)
+            sys.exit(1)
+        finally:
+            if self.history is not None:
+                self.history.flush()
+
+    #Creates a listening socket, setting SO_REUSEADDR before binding so a restart can bind again right away
+    #IPv6 sockets on the wildcard address accept IPv4 connections as well
+    def listen(self, host: str, port: int) -> socket:
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        s = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            if family == socket.AF_INET6:
+                s.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0 if host == "::" else 1)
+            s.bind((host, port))
+            s.listen(self.backlog)
+            s.setblocking(False)
+        except socket.error:
+            s.close()
+            raise
+        return s
+
+    #Single threaded event loop, sleeps in the selector until a socket is ready or the earliest client deadline
+    #allows for the server run indefinitely, or until it has handed over to a restarted server and has no clients left
+    #Every client, channel and index is owned by this loop and nothing else, so nothing is locked or copied to
+    #be iterated. Scaling past one core is done by running more of these in their own processes, each owning the
+    #connections the kernel hands it, and passing messages between them on the Bus, see serve_sharded
+    def run(self, *sockets: socket) -> None:
+        for s in sockets:
+            self.listeners.append(s)
+            self.selector.register(s, selectors.EVENT_READ, None)
+        while not self.stopping and not (self.draining and not self.clients):
+            deadline = min(self.timers[0][0] if self.timers else float("inf"),
+                           self.inputTimers[0][0] if self.inputTimers else float("inf"))
+            timeout = max(0, deadline - time.monotonic()) if deadline != float("inf") else None
+            for key, mask in self.selector.select(timeout):
+                if key.data is None:
+                    self.add_client(key.fileobj)
+                elif key.data is self.bus:
+                    self.bus.service(key.fileobj, mask)
+                elif key.data is self.metrics:
+                    self.serve_metrics(key.fileobj)
+                elif key.data is self.signals:
+                    self.receive_signals()
+                else:
+                    self.service_client(key.data, mask)
+            now = time.monotonic()
+            self.run_timers(now)
+            self.run_input(now)
+            self.run_disconnects()
+            if self.bus is not None:
+                self.bus.flush()
+            if self.restarting:
+                self.restarting = False
+                self.restart()
+
+    #Stops the server cleanly when it gets SIGTERM or SIGINT, so start still flushes the history, and restarts it
+    #when it gets SIGUSR2 if restarts is set, see restart
+    #Signals are turned into bytes on a socket the loop watches, so they are acted on between events
+    def handle_signals(self, restarts: bool) -> None:
+        self.signals, wakeup = socket.socketpair()
+        self.signals.setblocking(False)
+        wakeup.setblocking(False)
+        self.wakeup = wakeup
+        signal.set_wakeup_fd(wakeup.fileno())
+        handled = [signal.SIGTERM, signal.SIGINT] + ([signal.SIGUSR2] if restarts else [])
+        for signum in handled:
+            signal.signal(signum, lambda signum, frame: None)
+        self.selector.register(self.signals, selectors.EVENT_READ, self.signals)
+
+    def receive_signals(self) -> None:
+        try:
+            received = self.signals.recv(64)
+        except (BlockingIOError, InterruptedError):
+            return
+        if signal.SIGTERM in received or signal.SIGINT in received:
+            log.info("Stopping")
+            self.stopping = True
+        #the restart waits for the end of the loop iteration, so no client is in the middle of being dropped
+        elif signal.SIGUSR2 in received and not self.draining:
+            self.restarting = True
+
+    #Starts a new server process with the same arguments and hands everything over to it: the listening sockets,
+    #every client's connection, and a snapshot of the clients and channels. Connections keep queueing up in the
+    #listening sockets' backlog until the new process accepts them, and clients keep their connection, their
+    #nickname and their channels, so nobody notices. This process only lets go once the new one reports it has
+    #restored the snapshot, and exits soon after. If it doesn't, this process carries on as if nothing happened
+    def restart(self) -> None:
+        if self.history is not None:
+            self.history.flush()
+        clients = [client for client in self.clients if client.connected]
+        try:
+            path = self.write_snapshot(clients)
+        except OSError as e:
+            log.error("Could not write a snapshot: %s", e)
+            return
+        ready, report = socket.socketpair()
+        descriptors = ([s.fileno() for s in self.listeners] + [client.socket.fileno() for client in clients]
+                       + [report.fileno()])
+        environment = dict(os.environ, **{LISTEN_FDS: ",".join(str(s.fileno()) for s in self.listeners),
+                                          SNAPSHOT: path, READY_FD: str(report.fileno())})
+        if self.metricsSocket is not None:
+            descriptors.append(self.metricsSocket.fileno())
+            environment[METRICS_FD] = str(self.metricsSocket.fileno())
+        try:
+            process = subprocess.Popen([sys.executable] + sys.argv, pass_fds=descriptors, env=environment)
+        except OSError as e:
+            log.error("Could not start a new server: %s", e)
+            os.unlink(path)
+            return
+        finally:
+            report.close()
+        #the loop stands still until then, restoring takes tens of milliseconds even for tens of thousands of clients
+        try:
+            ready.settimeout(RESTART_TIMEOUT)
+            taken = ready.recv(1) == b"1"
+        except OSError:
+            taken = False
+        finally:
+            ready.close()
+        if not taken:
+            log.error("The new server (process %d) didn't take over, carrying on", process.pid)
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            if os.path.exists(path):
+                os.unlink(path)
+            return
+        log.info("Handed %d clients and the listening sockets over to process %d", len(clients), process.pid)
+        for s in self.listeners:
+            try:
+                self.selector.unregister(s)
+            except (KeyError, ValueError):
+                pass
+            s.close()
+        self.listeners.clear()
+        if self.metricsSocket is not None:
+            self.selector.unregister(self.metricsSocket)
+            self.metricsSocket.close()
+            self.metricsSocket = None
+        #the new process writes the history from now on
+        if self.history is not None:
+            for channel in self.channels.values():
+                if channel.log is not None:
+                    self.history.close(channel.log)
+                    channel.log = None
+            self.history = None
+            self.commands.pop(b"CHATHISTORY", None)
+        #the sockets stay open in the new process, so closing them here doesn't close the connections
+        for client in clients:
+            self.selector.unregister(client.socket)
+            client.socket.close()
+            client.connected = False
+        self.clients.clear()
+        self.draining = True
+
+    #Writes the clients and channels to a temporary file for the next process, returns its path
+    def write_snapshot(self, clients: List["Client"]) -> str:
+        numbers = {client: number for number, client in enumerate(clients)}
+        states = (snapshot.ClientState(client.socket.fileno(), client.host, client.port, client.nickname,
+                                       client.user, client.realname, client.lastActivity, client.pingSent,
+                                       client.readBuffer, client.discarding, b"".join(client.writeQueue or ()),
+                                       b"\n".join(client.recvQueue or ()))
+                  for client in clients)
+        channels = (snapshot.ChannelState(channel.name, [numbers[member] for member in channel.members
+                                                         if member in numbers])
+                    for channel in self.channels.values())
+        descriptor, path = tempfile.mkstemp(prefix="ircd-", suffix=".snapshot")
+        with open(descriptor, "wb", buffering=2 ** 20) as file:
+            snapshot.write(file, states, channels)
+        return path
+
+    #Takes over the clients and channels of the server this one replaces, from the snapshot it wrote
+    def restore(self, path: str) -> None:
+        with open(path, "rb") as file:
+            data = file.read()
+        os.unlink(path)
+        clients = []
+        now = time.monotonic()
+        for record in snapshot.read(data):
+            if isinstance(record, snapshot.ClientState):
+                conn = socket.socket(fileno=record.fd)
+                conn.setblocking(False)
+                client = Client(self, conn, (record.host.decode(), record.port))
+                client.user = record.user
+                client.realname = record.realname
+                client.lastActivity = record.lastActivity
+                client.pingSent = record.pingSent
+                client.readBuffer = record.readBuffer
+                client.discarding = record.discarding
+                self.selector.register(conn, selectors.EVENT_READ, client)
+                self.clients.add(client)
+                self.connectionsByHost[record.host.decode()] = self.connectionsByHost.get(record.host.decode(), 0) + 1
+                if record.nickname:
+                    client.nickname = record.nickname
+                    self.nicknames[irc_lower(record.nickname)] = client
+                if record.output:
+                    client.write(record.output)
+                if record.queuedInput:
+                    client.recvQueue = deque(record.queuedInput.split(b"\n"))
+                    client.recvQueued = sum(map(len, client.recvQueue))
+                    self.schedule_input(client, now)
+                self.schedule(client, now)
+                clients.append(client)
+            else:
+                channel = Channel(self, record.name)
+                for number in record.members:
+                    channel.add_member(clients[number])
+                    clients[number].channels.add(channel)
+                if channel.members:
+                    self.add_channel(channel)
+        log.info("Took over %d clients and %d channels", len(clients), len(self.channels))
+
+    #Handles a single readiness event for a client
+    def service_client(self, client: "Client", mask: int) -> None:
+        try:
+            if mask & selectors.EVENT_READ and client.connected:
+                client.check_msg()
+            if mask & selectors.EVENT_WRITE and client.connected:
+                client.send_msg()
+        except Exception:
+            log.exception("Error servicing %s", client.host.decode())
+
+    #Clients can't be dropped in the middle of a channel fan-out, so this waits for the end of the loop iteration
+    def schedule_disconnect(self, client: "Client", reason: bytes) -> None:
+        self.disconnects.append((client, reason))
+
+    def run_disconnects(self) -> None:
+        while self.disconnects:
+            client, reason = self.disconnects.pop()
+            client.close_link(reason)
+
+    #Accepts waiting connections until the backlog is empty, the batch is done or the throttle says to stop
+    #Whatever is left waits for the next loop iteration, so clients already connected get their turn in between
+    def add_client(self, s: socket) -> None:
+        #another listener that was ready in the same select may have used up the last token
+        if self.throttle.paused:
+            return
+        for _ in range(self.accept_batch):
+            start = time.perf_counter_ns()
+            try:
+                conn, addr = s.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except socket.error as e:
+                log.warning("Socket error accepting a connection: %s", e)
+                return
+            self.admit(conn, addr)
+            self.metrics.accept.observe(time.perf_counter_ns() - start)
+            if not self.throttle.take(time.monotonic()):
+                return
+
+    #Adds an accepted connection as a client, unless its address already has too many
+    def admit(self, conn: socket, addr: Tuple) -> None:
+        host = addr[0]
+        if self.max_per_ip and self.connectionsByHost.get(host, 0) >= self.max_per_ip:
+            self.metrics.rejected += 1
+            log.debug("Rejected connection from %s:%d, too many connections", host, addr[1])
+            try:
+                conn.setblocking(False)
+                conn.send(b"ERROR :Closing Link: %s (Too many connections from your host)\r\n" % host.encode())
+            except socket.error:
+                pass
+            conn.close()
+            return
+        try:
+            conn.setblocking(False)
+            client = Client(self, conn, addr)
+            self.selector.register(conn, selectors.EVENT_READ, client)
+        except socket.error as e:
+            log.warning("Socket error setting up a connection: %s", e)
+            conn.close()
+            return
+        self.clients.add(client)
+        self.connectionsByHost[host] = self.connectionsByHost.get(host, 0) + 1
+        self.schedule(client, client.lastActivity + self.ping_interval)
+        self.metrics.accepted += 1
+        log.debug("Accepted connection from %s:%d", host, addr[1])
+
+    #Serves the metrics on a unix socket, every connection gets them once and is closed
+    #A restarted server takes the socket over from the server it replaces instead, which keeps serving metrics on
+    #it if the restart fails
+    def listen_metrics(self, path: str) -> None:
+        descriptor = os.environ.pop(METRICS_FD, None)
+        if descriptor is not None:
+            s = socket.socket(fileno=int(descriptor))
+        else:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.bind(path)
+            s.listen(5)
+        s.setblocking(False)
+        self.metricsSocket = s
+        self.selector.register(s, selectors.EVENT_READ, self.metrics)
+
+    def serve_metrics(self, s: socket) -> None:
+        try:
+            conn, _ = s.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        with conn:
+            try:
+                #a scrape is small enough to fit in the socket buffer, so this doesn't hold the loop up
+                conn.settimeout(1)
+                conn.sendall(self.metrics.render(self))
+            except socket.error as e:
+                log.warning("Socket error serving metrics: %s", e)
+
+    #Sets when the client's timeout should next be checked
+    def schedule(self, client: "Client", deadline: float) -> None:
+        heapq.heappush(self.timers, (deadline, next(self.timerSequence), client))
+
+    #Only touches the clients whose deadline has expired
+    def run_timers(self, now: float) -> None:
+        while self.timers and self.timers[0][0] <= now:
+            _, _, client = heapq.heappop(self.timers)
+            client.check_timeout(now)
+
+    #Sets when a client with queued input may send its next line
+    def schedule_input(self, client: "Client", when: float) -> None:
+        heapq.heappush(self.inputTimers, (when, next(self.timerSequence), client))
+
+    def run_input(self, now: float) -> None:
+        while self.inputTimers and self.inputTimers[0][0] <= now:
+            _, _, client = heapq.heappop(self.inputTimers)
+            try:
+                client.process_queued(now)
+            except Exception:
+                log.exception("Error servicing %s", client.host.decode())
+                #the failed line is already off the queue, so carry on with the rest
+                if client.recvQueue and client.connected:
+                    self.schedule_input(client, now)
+
+    #Remove client details from server
+    def remove_client(self, client: "Client") -> None:
+        try:
+            self.selector.unregister(client.socket)
+        except (KeyError, ValueError):
+            pass
+        if client in self.clients:
+            self.clients.remove(client)
+            host = client.host.decode()
+            if self.connectionsByHost[host] > 1:
+                self.connectionsByHost[host] -= 1
+            else:
+                del self.connectionsByHost[host]
+        if client.nickname and self.nicknames.get(irc_lower(client.nickname)) is client:
+            del self.nicknames[irc_lower(client.nickname)]
+            if self.bus is not None:
+                self.bus.publish_quit(client.nickname)
+
+    #Switches whether the selector should report the client's socket as writable
+    def want_write(self, client: "Client", enabled: bool) -> None:
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if enabled else selectors.EVENT_READ
+        try:
+            self.selector.modify(client.socket, events, client)
+        except (KeyError, ValueError):
+            pass
+
+    #Adds or replaces a command handler, so extensions don't have to touch Client
+    def register_command(self, name: bytes, handler: Handler, min_args: int = 0) -> None:
+        self.commands[name.upper()] = (handler, min_args)
+
+    #Keeps the history of every channel from now on, replays it to joining clients and answers CHATHISTORY
+    def enable_history(self, history: History) -> None:
+        self.history = history
+        for channel in self.channels.values():
+            channel.log = self.open_log(channel.name)
+        self.register_command(b"CHATHISTORY", Client.chathistory_command, 4)
+
+    #gets client object
+    def get_client(self, clientName: bytes) -> Optional["Client"]:
+        return self.nicknames.get(irc_lower(clientName))
+
+    #Moves a client to a new nickname in the nickname index
+    def rename_client(self, client: "Client", nickname: bytes) -> None:
+        if client.nickname and self.nicknames.get(irc_lower(client.nickname)) is client:
+            del self.nicknames[irc_lower(client.nickname)]
+        oldnickname = client.nickname
+        client.nickname = nickname
+        self.nicknames[irc_lower(nickname)] = client
+        if self.bus is not None:
+            self.bus.publish_nick(oldnickname, nickname)
+
+    #Checks whether a nickname is taken by anyone but the given client, on this shard or any other
+    def nick_in_use(self, nickname: bytes, client: "Client") -> bool:
+        owner = self.get_client(nickname)
+        if owner is not None:
+            return owner is not client
+        return self.bus is not None and self.bus.owner(nickname) is not None
+
+    #gets channel object
+    def get_channel(self, channelName: bytes) -> Optional["Channel"]:
+        return self.channels.get(irc_lower(channelName))
+
+    #adds channel to server
+    def add_channel(self, channel: "Channel") -> None:
+        if self.history is not None:
+            channel.log = self.open_log(channel.name)
+        self.channels[irc_lower(channel.name)] = channel
+
+    #A channel whose history can't be opened still works, it just isn't logged
+    def open_log(self, name: bytes) -> Optional[ChannelLog]:
+        try:
+            return self.history.open(irc_lower(name))
+        except OSError as e:
+            log.warning("Could not open the history of %s: %s", name.decode(errors="replace"), e)
+            return None
+
+    #Buffers a line in a channel's history, scheduling the next flush if nothing was waiting for one
+    def record(self, channelLog: ChannelLog, line: bytes) -> None:
+        if self.history.record(channelLog, line):
+            self.schedule(self.history, time.monotonic() + self.history.flushInterval)
+
+    #Keeps a line said on another shard in the history of a channel nobody here is on, every shard has its own copy
+    #The log is only held for this line, it is closed again once the line has been flushed
+    def record_remote(self, name: bytes, line: bytes) -> None:
+        channelLog = self.open_log(name)
+        if channelLog is not None:
+            self.record(channelLog, line)
+            self.history.close(channelLog)
+
+    #removes channel from server
+    def remove_channel(self, channel: "Channel") -> None:
+        if self.channels.get(irc_lower(channel.name)) is channel:
+            del self.channels[irc_lower(channel.name)]
+        if channel.log is not None:
+            self.history.close(channel.log)
+            channel.log = None
+
+
+#Connects the shards of a sharded server to each other over unix datagram sockets
+#Each shard tells the others about nickname changes and forwards channel lines and private messages
+#Nicknames are claimed optimistically, two shards may accept the same new nickname at the same moment
+#Messages for a peer wait in its outbox until the end of the loop iteration, then go out packed into as few
+#datagrams as possible. Datagrams a peer isn't ready for are queued until it is, rather than dropped
+class Bus:
+    def __init__(self, server: "Server", shard: int, peers: Dict[int, Socket]) -> None:
+        self.server = server
+        self.shard = shard
+        self.peers = peers
+        self.shards = {peer: shard for shard, peer in peers.items()}
+        #folded nickname -> shard that owns it
+        self.remoteNicknames = {}
+        #messages for each peer that haven't been packed into datagrams yet
+        self.outboxes = {peer: [] for peer in peers.values()}
+        self.dirty = set()
+        #datagrams each peer wasn't ready for, and their total size
+        self.backlogs = {peer: deque() for peer in peers.values()}
+        self.backlogged = dict.fromkeys(peers.values(), 0)
+        for peer in peers.values():
+            peer.setblocking(False)
+            server.selector.register(peer, selectors.EVENT_READ, self)
+
+    def owner(self, nickname: bytes) -> Optional[int]:
+        return self.remoteNicknames.get(irc_lower(nickname))
+
+    def publish(self, message: bytes) -> None:
+        for peer in self.peers.values():
+            self.send(peer, message)
+
+    def send(self, peer: Socket, message: bytes) -> None:
+        self.outboxes[peer].append(message)
+        self.dirty.add(peer)
+
+    #Packs every outbox into datagrams and sends them, called once per loop iteration
+    def flush(self) -> None:
+        for peer in self.dirty:
+            outbox = self.outboxes[peer]
+            datagram = []
+            size = 0
+            for message in outbox:
+                if size + BUS_HEADER.size + len(message) > READ_SIZE and datagram:
+                    self.send_datagram(peer, b"".join(datagram))
+                    datagram = []
+                    size = 0
+                datagram += (BUS_HEADER.pack(len(message)), message)
+                size += BUS_HEADER.size + len(message)
+            self.send_datagram(peer, b"".join(datagram))
+            outbox.clear()
+        self.dirty.clear()
+
+    def send_datagram(self, peer: Socket, datagram: bytes) -> None:
+        backlog = self.backlogs[peer]
+        if not backlog:
+            try:
+                peer.send(datagram)
+                return
+            except (BlockingIOError, InterruptedError):
+                self.server.selector.modify(peer, selectors.EVENT_READ | selectors.EVENT_WRITE, self)
+            except socket.error as e:
+                log.warning("Socket error on the bus to shard %d: %s", self.shards[peer], e)
+                return
+        if self.backlogged[peer] + len(datagram) > MAX_BUS_BACKLOG:
+            log.warning("Bus to shard %d is backlogged, dropping messages", self.shards[peer])
+            return
+        backlog.append(datagram)
+        self.backlogged[peer] += len(datagram)
+
+    #Handles a readiness event on a peer socket
+    def service(self, peer: Socket, mask: int) -> None:
+        if mask & selectors.EVENT_READ:
+            self.receive(peer)
+        if mask & selectors.EVENT_WRITE:
+            self.send_backlog(peer)
+
+    def send_backlog(self, peer: Socket) -> None:
+        backlog = self.backlogs[peer]
+        while backlog:
+            try:
+                peer.send(backlog[0])
+            except (BlockingIOError, InterruptedError):
+                return
+            except socket.error as e:
+                log.warning("Socket error on the bus to shard %d: %s", self.shards[peer], e)
+            self.backlogged[peer] -= len(backlog.popleft())
+        self.server.selector.modify(peer, selectors.EVENT_READ, self)
+
+    def publish_channel(self, name: bytes, line: bytes) -> None:
+        self.publish(b"C%s %s" % (name, line))
+
+    #A channel message that is also kept in history
+    def publish_message(self, name: bytes, line: bytes) -> None:
+        self.publish(b"M%s %s" % (name, line))
+
+    def publish_nick(self, oldnickname: bytes, nickname: bytes) -> None:
+        self.publish(b"N%s %s" % (oldnickname or b"*", nickname))
+
+    def publish_quit(self, nickname: bytes) -> None:
+        self.publish(b"Q%s" % nickname)
+
+    #Forwards a line to whichever shard owns the nickname, returns whether there is one
+    def send_user(self, nickname: bytes, line: bytes) -> bool:
+        shard = self.owner(nickname)
+        if shard is None:
+            return False
+        self.send(self.peers[shard], b"U%s %s" % (nickname, line))
+        return True
+
+    #Handles everything waiting on a peer socket
+    def receive(self, peer: Socket) -> None:
+        shard = self.shards[peer]
+        while True:
+            try:
+                datagram = peer.recv(READ_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            if not datagram:
+                return
+            position = 0
+            while position < len(datagram):
+                length, = BUS_HEADER.unpack_from(datagram, position)
+                position += BUS_HEADER.size
+                self.handle(shard, datagram[position:position + length])
+                position += length
+
+    #Applies a single message from a peer
+    def handle(self, shard: int, message: bytes) -> None:
+        kind, body = message[:1], message[1:]
+        if kind == b"C":
+            name, line = body.split(b" ", 1)
+            channel = self.server.get_channel(name)
+            if channel is not None:
+                channel.deliver(line)
+        elif kind == b"M":
+            name, line = body.split(b" ", 1)
+            channel = self.server.get_channel(name)
+            if channel is not None:
+                channel.deliver(line)
+                channel.record(line)
+            elif self.server.history is not None:
+                self.server.record_remote(name, line)
+        elif kind == b"U":
+            nickname, line = body.split(b" ", 1)
+            client = self.server.get_client(nickname)
+            if client is not None:
+                client.write(line)
+        elif kind == b"N":
+            oldnickname, nickname = body.split(b" ", 1)
+            if self.remoteNicknames.get(irc_lower(oldnickname)) == shard:
+                del self.remoteNicknames[irc_lower(oldnickname)]
+            self.remoteNicknames[irc_lower(nickname)] = shard
+        elif kind == b"Q":
+            if self.remoteNicknames.get(irc_lower(body)) == shard:
+                del self.remoteNicknames[irc_lower(body)]
+
+
+#Tells the server being replaced that this one has taken over, see Server.restart
+def report_ready() -> None:
+    descriptor = os.environ.pop(READY_FD, None)
+    if descriptor is not None:
+        with socket.socket(fileno=int(descriptor)) as report:
+            report.sendall(b"1")
+
+
+#The listening sockets a restarted server was handed, see Server.restart
+def inherited_listeners() -> List[socket.socket]:
+    descriptors = os.environ.pop(LISTEN_FDS, "")
+    sockets = []
+    for descriptor in filter(None, descriptors.split(",")):
+        s = socket.socket(fileno=int(descriptor))
+        s.setblocking(False)
+        sockets.append(s)
+    return sockets
+
+
+#Forks one server per worker, all listening on the same port through SO_REUSEPORT so the kernel spreads
+#connections between them, and waits for them to exit. SIGTERM and SIGINT are passed on to them
+#setup is called with each shard's server and its number before it starts
+def serve_sharded(workers: int, setup: Callable[["Server", Optional[int]], None]) -> None:
+    links = {}
+    for a in range(workers):
+        for b in range(a + 1, workers):
+            links[a, b] = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    children = []
+    for shard in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            peers = {}
+            for (a, b), (end_a, end_b) in links.items():
+                if a == shard:
+                    peers[b] = end_a
+                    end_b.close()
+                elif b == shard:
+                    peers[a] = end_b
+                    end_a.close()
+                else:
+                    end_a.close()
+                    end_b.close()
+            server = Server()
+            server.reuse_port = True
+            server.bus = Bus(server, shard, peers)
+            try:
+                setup(server, shard)
+                server.handle_signals(restarts=False)
+                server.start()
+            finally:
+                stop_logging()
+            os._exit(0)
+        children.append(pid)
+
+    for end_a, end_b in links.values():
+        end_a.close()
+        end_b.close()
+
+    #Stopping the parent, as a supervisor does, stops every shard with it
+    #Always SIGTERM, as shards started in the background may be ignoring SIGINT
+    def stop(signum: int, frame: Any) -> None:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for pid in children:
+        os.waitpid(pid, 0)
+
+
+#Parses HOST/PORT. Slashes, because ipv6 addresses are full of colons
+def address(value: str) -> Tuple[str, int]:
+    try:
+        host, port = value.rsplit("/", 1)
+        return host, int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected HOST/PORT, got {value}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(fromfile_prefix_chars="@",
+                                     epilog="Options can also be read from a file given as @FILE, one per line. "
+                                     "Sending the server SIGUSR2 starts a new server with the same options that takes "
+                                     "over the listening sockets and every connected client, then exits")
+    parser.add_argument("--listen", help="address to listen on. Can be given more than once. :: listens on every "
+                        "IPv6 and IPv4 address. Defaults to fc00:1337::17/6667", type=address, action="append",
+                        metavar="HOST/PORT")
+    parser.add_argument("--server-name", help='name the server uses in its messages. Defaults to "fc00:1337::17"',
+                        default="fc00:1337::17")
+    parser.add_argument("--workers", help="number of server processes sharing the port. Defaults to 1",
+                        type=int, default=1)
+    parser.add_argument("--ping-interval", help="seconds a client may be silent before it is pinged. Defaults to 120",
+                        type=float, default=120)
+    parser.add_argument("--ping-timeout", help="seconds a client has to answer a ping. Defaults to 60",
+                        type=float, default=60)
+    parser.add_argument("--max-sendq", help="bytes that may be queued for a client before it is disconnected. "
+                        "Defaults to 1048576", type=int, default=2 ** 20)
+    parser.add_argument("--history-dir", help="keep channel history in this directory, replay it to clients joining "
+                        "a channel and answer CHATHISTORY. Every shard keeps its own copy")
+    parser.add_argument("--history-replay", help="lines of history sent to a client joining a channel. Defaults to 20",
+                        type=int, default=20)
+    parser.add_argument("--backlog", help="connections the kernel queues for accepting. Defaults to 1024",
+                        type=int, default=1024)
+    parser.add_argument("--max-per-ip", help="most connections from a single address, 0 for no limit. Defaults to 0",
+                        type=int, default=0)
+    parser.add_argument("--accept-rate", help="most connections accepted a second once the burst is used up, "
+                        "0 for no limit. Defaults to 0", type=float, default=0)
+    parser.add_argument("--accept-burst", help="connections accepted at once before --accept-rate applies. "
+                        "Defaults to 100", type=int, default=100)
+    parser.add_argument("--flood-rate", help="lines a second a client may send once its burst is used up, "
+                        "0 for no limit. Lines sent faster wait their turn. Defaults to 2", type=float, default=2.0)
+    parser.add_argument("--flood-burst", help="lines a client may send at once. Defaults to 10", type=int, default=10)
+    parser.add_argument("--max-recvq", help="bytes of lines a client may have waiting before it is disconnected "
+                        "for flooding. Defaults to 8192", type=int, default=8192)
+    parser.add_argument("--metrics-socket", help="serve metrics in the Prometheus text format on this unix socket. "
+                        "When sharded, every shard gets its own, with the shard number appended")
+    parser.add_argument("--log-level", help='least severe messages logged. Defaults to "info"',
+                        choices=["debug", "info", "warning", "error", "critical"], default="info")
+    args = parser.parse_args()
+
+    #shard is None when not running sharded
+    def setup(server: Server, shard: Optional[int]) -> None:
+        start_logging(args.log_level)
+        server.addresses = args.listen or server.addresses
+        server.host = args.server_name.encode()
+        server.ping_interval = args.ping_interval
+        server.ping_timeout = args.ping_timeout
+        server.max_sendq = args.max_sendq
+        server.backlog = args.backlog
+        server.max_per_ip = args.max_per_ip
+        server.flood_rate = args.flood_rate
+        server.flood_window = args.flood_burst / args.flood_rate if args.flood_rate else 0
+        server.max_recvq = args.max_recvq
+        server.throttle = AcceptThrottle(server, args.accept_rate, args.accept_burst)
+        if args.metrics_socket:
+            server.listen_metrics(args.metrics_socket if shard is None else f"{args.metrics_socket}.{shard}")
+        if args.history_dir:
+            directory = args.history_dir if shard is None else os.path.join(args.history_dir, f"shard-{shard}")
+            server.enable_history(History(directory, args.history_replay))
+
+    if args.workers > 1:
+        serve_sharded(args.workers, setup)
+    else:
+        server = Server()
+        setup(server, None)
+        server.handle_signals(restarts=True)
+        server.start()
+
+
+if __name__ == "__main__":
+    main()
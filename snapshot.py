@@ -0,0 +1,111 @@
+import struct
+
+from array import array
+from typing import BinaryIO, Iterable, Iterator, List, NamedTuple, Optional, Union
+
+MAGIC = b"IRCSNAP2"
+#fd, port, last activity, time the unanswered ping was sent or -1, whether a too long line is being discarded, then
+#the lengths of the host, nickname, user, realname, read buffer, output and queued input that follow, so a client
+#is read with a single unpack
+CLIENT = struct.Struct("!iHddBHHHHHII")
+#length of the name, number of members
+CHANNEL = struct.Struct("!HI")
+#Channel members are written as an array of client numbers in native byte order, snapshots never leave the machine
+MEMBER = "I"
+
+
+class Error(Exception):
+    "The snapshot is damaged or from an incompatible version"
+
+
+#A connection, as handed from one server process to the next
+#fd is the connection's file descriptor, which the next process inherits, and times are time.monotonic()
+class ClientState(NamedTuple):
+    fd: int
+    host: bytes
+    port: int
+    nickname: bytes
+    user: bytes
+    realname: bytes
+    lastActivity: float
+    pingSent: Optional[float]
+    readBuffer: bytes
+    discarding: bool
+    #output that was queued but not sent yet
+    output: bytes
+    #lines received over the flood rate and not processed yet, separated by \n
+    queuedInput: bytes
+
+
+#members are indices into the clients, in the order they joined
+class ChannelState(NamedTuple):
+    name: bytes
+    members: List[int]
+
+
+#Writes a snapshot a record at a time, so nothing has to be built up for the whole server first
+#Clients are numbered in the order they are written, and channels can only refer to clients written before them
+def write(file: BinaryIO, clients: Iterable[ClientState], channels: Iterable[ChannelState]) -> None:
+    file.write(MAGIC)
+    for client in clients:
+        file.write(b"".join((
+            b"C",
+            CLIENT.pack(client.fd, client.port, client.lastActivity,
+                        -1 if client.pingSent is None else client.pingSent, client.discarding,
+                        len(client.host), len(client.nickname), len(client.user), len(client.realname),
+                        len(client.readBuffer), len(client.output), len(client.queuedInput)),
+            client.host, client.nickname, client.user, client.realname, client.readBuffer, client.output,
+            client.queuedInput,
+        )))
+    for channel in channels:
+        members = array(MEMBER, channel.members)
+        file.write(b"J" + CHANNEL.pack(len(channel.name), len(members)) + channel.name + members.tobytes())
+    file.write(b"E")
+
+
+#Reads a whole snapshot, yielding its records in the order they were written
+def read(data: bytes) -> Iterator[Union[ClientState, ChannelState]]:
+    if not data.startswith(MAGIC):
+        raise Error("not a snapshot")
+    unpack_client = CLIENT.unpack_from
+    position = len(MAGIC)
+    try:
+        while True:
+            kind = data[position:position + 1]
+            position += 1
+            if kind == b"C":
+                (fd, port, lastActivity, pingSent, discarding,
+                 hostLength, nicknameLength, userLength, realnameLength, bufferLength,
+                 outputLength, inputLength) = unpack_client(data, position)
+                position += CLIENT.size
+                host = data[position:position + hostLength]
+                position += hostLength
+                nickname = data[position:position + nicknameLength]
+                position += nicknameLength
+                user = data[position:position + userLength]
+                position += userLength
+                realname = data[position:position + realnameLength]
+                position += realnameLength
+                readBuffer = data[position:position + bufferLength]
+                position += bufferLength
+                output = data[position:position + outputLength]
+                position += outputLength
+                queuedInput = data[position:position + inputLength]
+                position += inputLength
+                yield ClientState(fd, host, port, nickname, user, realname, lastActivity,
+                                  None if pingSent < 0 else pingSent, readBuffer, discarding == 1, output, queuedInput)
+            elif kind == b"J":
+                nameLength, count = CHANNEL.unpack_from(data, position)
+                position += CHANNEL.size
+                name = data[position:position + nameLength]
+                position += nameLength
+                members = array(MEMBER)
+                members.frombytes(data[position:position + members.itemsize * count])
+                position += members.itemsize * count
+                yield ChannelState(name, members.tolist())
+            elif kind == b"E":
+                return
+            else:
+                raise Error(f"unknown record {kind!r} at {position - 1}")
+    except struct.error as e:
+        raise Error(f"truncated snapshot: {e}")